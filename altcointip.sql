@@ -16,8 +16,27 @@ CREATE TABLE IF NOT EXISTS `t_action` (
   `subreddit` varchar(30) DEFAULT NULL,
   `msg_id` varchar(10) NOT NULL,
   `msg_link` varchar(200) DEFAULT NULL,
+  `id` int(11) unsigned NOT NULL AUTO_INCREMENT,
   PRIMARY KEY (`type`,`created_utc`,`msg_id`),
-  UNIQUE KEY `msg_id` (`msg_id`)
+  UNIQUE KEY `msg_id` (`msg_id`),
+  UNIQUE KEY `id` (`id`),
+  KEY `idx_to_user_state_type` (`to_user`,`state`,`type`),
+  KEY `idx_state_created_utc` (`state`,`created_utc`),
+  KEY `idx_from_user_type_state_coin` (`from_user`,`type`,`state`,`coin`),
+  KEY `idx_type_state_coin` (`type`,`state`,`coin`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE IF NOT EXISTS `t_action_summary` (
+  `type` varchar(10) NOT NULL,
+  `state` varchar(10) NOT NULL,
+  `coin` varchar(3) NOT NULL DEFAULT '',
+  `fiat` varchar(3) NOT NULL DEFAULT '',
+  `from_user` varchar(30) NOT NULL,
+  `to_user` varchar(30) NOT NULL DEFAULT '',
+  `total_coin` double DEFAULT NULL,
+  `total_fiat` double DEFAULT NULL,
+  `count` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`type`,`state`,`coin`,`fiat`,`from_user`,`to_user`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 CREATE TABLE IF NOT EXISTS `t_addrs` (
@@ -28,6 +47,26 @@ CREATE TABLE IF NOT EXISTS `t_addrs` (
   UNIQUE KEY `address` (`address`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
+CREATE TABLE IF NOT EXISTS `t_addr_pool` (
+  `id` int(11) unsigned NOT NULL AUTO_INCREMENT,
+  `coin` varchar(3) NOT NULL,
+  `address` varchar(34) NOT NULL,
+  `created_utc` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `address` (`address`),
+  KEY `idx_coin_id` (`coin`,`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE IF NOT EXISTS `t_user_totals` (
+  `username` varchar(30) NOT NULL,
+  `direction` enum('tipped','received') NOT NULL,
+  `kind` enum('coin','fiat') NOT NULL,
+  `unit` varchar(3) NOT NULL,
+  `total` double NOT NULL DEFAULT '0',
+  `count` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`username`,`direction`,`kind`,`unit`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
 CREATE TABLE IF NOT EXISTS `t_users` (
   `username` varchar(30) NOT NULL,
   `joindate` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
@@ -23,18 +23,25 @@ if hasattr(ctb.conf.misc.backup, 'encryptionpassphrase') and not find_executable
 	print "encryptionpassphrase is specified but gpg executable not found, please install gpg"
 	sys.exit(1)
 
-for c in ctb.coins:
-	if ctb.conf.coins[c].config_rpcserver != '127.0.0.1':
-		# Skip non-local coins
+# Skip non-local coins
+coins = [c for c in sorted(ctb.coins) if ctb.conf.coins[c].config_rpcserver == '127.0.0.1']
+filenames = {}
+for c in coins:
+	filenames[c] = "%s/wallet_%s_%s.dat" % (sys.argv[1], ctb.conf.coins[c].unit, datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+	print "Backing up %s wallet to %s..." % (ctb.conf.coins[c].name, filenames[c])
+
+# Back up all wallets at once
+results, errors = ctb.each_coin(lambda c: ctb.coins[c].rpc('backupwallet', filenames[c]), coins=coins)
+for c in sorted(errors):
+	print "Error backing up %s wallet: %s" % (ctb.conf.coins[c].name, errors[c])
+
+for c in coins:
+	if c in errors:
 		continue
+	filename = filenames[c]
 
-	filename = "%s/wallet_%s_%s.dat" % (sys.argv[1], ctb.conf.coins[c].unit, datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
-
-	print "Backing up %s wallet to %s..." % (ctb.conf.coins[c].name, filename)
-	ctb.coins[c].conn.backupwallet(filename)
-
-	print "Compressing..."
-        os.popen("gzip --best %s" % filename)
+	print "Compressing %s..." % filename
+	os.popen("gzip --best %s" % filename)
 	filename += '.gz'
 
 	try:
@@ -48,3 +55,6 @@ for c in ctb.coins:
 	if len(sys.argv) == 3:
 		print "Calling rsync..."
 		os.popen("rsync -urltv %s %s" % (filename, sys.argv[2]))
+
+if errors:
+	sys.exit(1)
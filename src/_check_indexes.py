@@ -0,0 +1,38 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Simple script to check (using EXPLAIN) that configured stats queries use t_action indexes
+
+import cointipbot, sys
+from ctb import ctb_db
+
+ctb = cointipbot.CointipBot(self_checks=False, init_reddit=False, init_coins=False, init_exchanges=False, init_db=True, init_logging=False)
+
+queries = []
+for s in sorted(vars(ctb.conf.db.sql.globalstats)):
+	queries.append(('globalstats.' + s, ctb.conf.db.sql.globalstats[s].query))
+for s in sorted(vars(ctb.conf.db.sql.userstats)):
+	queries.append(('userstats.' + s, ctb.conf.db.sql.userstats[s]))
+queries.append(('userhistory.sql', ctb.conf.db.sql.userhistory.sql))
+queries.append(('tips.sql_list', ctb.conf.db.sql.tips.sql_list))
+
+scans = ctb_db.check_indexes(ctb.db, queries)
+for name, r in scans:
+	print "%s: full scan of %s (~%s rows)" % (name, r['table'], r['rows'])
+
+print "%s queries checked, %s full scans of t_action" % (len(queries), len(scans))
+sys.exit(1 if scans else 0)
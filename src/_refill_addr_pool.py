@@ -0,0 +1,47 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Simple script to fill t_addr_pool with pre-generated addresses, run it periodically (e.g. from cron) during quiet hours
+
+import cointipbot, logging, sys
+from ctb import ctb_misc
+
+if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
+	print "Usage: %s [COIN ...]" % sys.argv[0]
+	print "(fills address pool of given coins, or of all enabled coins, up to addr_pool_size from coins.yml)"
+	sys.exit(1)
+
+logging.basicConfig()
+lg = logging.getLogger('cointipbot')
+lg.setLevel(logging.INFO)
+
+ctb = cointipbot.CointipBot(self_checks=False, init_reddit=False, init_coins=True, init_exchanges=False, init_db=True, init_logging=False)
+
+failed = False
+for c in sys.argv[1:] or sorted(ctb.coins):
+	if not c in ctb.coins:
+		print "%s is not an enabled coin" % c
+		failed = True
+		continue
+	size = ctb.conf.coins[c].addr_pool_size if hasattr(ctb.conf.coins[c], 'addr_pool_size') else 100
+	try:
+		print "%s: %s addresses added" % (c, ctb_misc.refill_addr_pool(c, ctb.db, ctb.coins, size))
+	except Exception as e:
+		print "%s: error: %s" % (c, e)
+		failed = True
+
+sys.exit(1 if failed else 0)
@@ -15,7 +15,7 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import cointipbot, logging
+import cointipbot, logging, sys
 from ctb import ctb_stats
 
 logging.basicConfig()
@@ -24,8 +24,8 @@ lg.setLevel(logging.DEBUG)
 
 ctb = cointipbot.CointipBot(self_checks=False, init_reddit=True, init_coins=False, init_exchanges=False, init_db=True, init_logging=False)
 
-# Update stats page
-result = ctb_stats.update_stats(ctb=ctb)
+# Update stats page (pass --rebuild to recompute t_action_summary from scratch)
+result = ctb_stats.update_stats(ctb=ctb, rebuild=('--rebuild' in sys.argv))
 lg.debug(result)
 
 # Update tips page
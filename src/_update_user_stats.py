@@ -0,0 +1,35 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Simple script to update stats pages (and flair) of all users
+
+import cointipbot, logging, sys
+from ctb import ctb_stats
+
+if not len(sys.argv) in [1, 2]:
+	print "Usage: %s [RESUME-FILE]" % sys.argv[0]
+	print "(RESUME-FILE is optional, it keeps track of progress so that an interrupted run can be resumed)"
+	sys.exit(1)
+
+logging.basicConfig()
+lg = logging.getLogger('cointipbot')
+lg.setLevel(logging.INFO)
+
+ctb = cointipbot.CointipBot(self_checks=False, init_reddit=True, init_coins=False, init_exchanges=False, init_db=True, init_logging=False)
+
+result = ctb_stats.update_all_user_stats(ctb=ctb, resume_file=sys.argv[1] if len(sys.argv) == 2 else None)
+sys.exit(0 if result else 1)
@@ -0,0 +1,38 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Simple script to check or rebuild t_user_totals from t_action
+
+import cointipbot, sys
+from ctb import ctb_db, ctb_stats
+
+if len(sys.argv) != 2 or not sys.argv[1] in ['check', 'rebuild']:
+	print "Usage: %s check|rebuild" % sys.argv[0]
+	sys.exit(1)
+
+ctb = cointipbot.CointipBot(self_checks=False, init_reddit=False, init_coins=False, init_exchanges=False, init_db=True, init_logging=False)
+
+if sys.argv[1] == 'rebuild':
+	with ctb.db.unit_of_work():
+		print "%s rows rebuilt" % ctb_db.rebuild_user_totals(ctb.db)
+
+mismatches = ctb_stats.check_user_totals(ctb=ctb)
+for k, e, a in mismatches:
+	print "%s: expected total %s (count %s), found %s (count %s)" % ('/'.join(k), e[0], e[1], a[0], a[1])
+
+print "%s mismatches" % len(mismatches)
+sys.exit(1 if mismatches else 0)
@@ -16,9 +16,9 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from ctb import ctb_action, ctb_coin, ctb_db, ctb_exchange, ctb_log, ctb_misc, ctb_user
+from ctb import ctb_action, ctb_coin, ctb_db, ctb_exchange, ctb_log, ctb_misc, ctb_stats, ctb_user
 
-import gettext, locale, logging, praw, smtplib, sys, time, traceback, yaml
+import collections, contextlib, gettext, locale, logging, praw, smtplib, sys, time, traceback, yaml
 from email.mime.text import MIMEText
 from jinja2 import Environment, PackageLoader
 
@@ -41,7 +41,7 @@ class CointipBot(object):
     coins = {}
     exchanges = {}
     jenv = None
-    runtime = {'ev': {}, 'regex': []}
+    runtime = {'ev': {}, 'regex': [], 'prefilter': {}, 'counters': {'prefilter_rejected': 0}, 'recent_msg_ids': collections.OrderedDict(), 'sql': {}, 'stats': {'dirty': {}, 'published': {}, 'hashes': {}}, 'formatters': {}}
 
     def init_logging(self):
         """
@@ -107,7 +107,7 @@ class CointipBot(object):
         lg.debug('CointipBot::connect_db(): connecting to database...')
 
         dsn = "mysql+mysqldb://%s:%s@%s:%s/%s?charset=utf8" % (self.conf.db.auth.user, self.conf.db.auth.password, self.conf.db.auth.host, self.conf.db.auth.port, self.conf.db.auth.dbname)
-        dbobj = ctb_db.CointipBotDatabase(dsn)
+        dbobj = ctb_db.CointipBotDatabase(dsn, pool=self.conf.db.pool if hasattr(self.conf.db, 'pool') else None)
 
         try:
             conn = dbobj.connect()
@@ -135,6 +135,42 @@ class CointipBot(object):
         lg.info("CointipBot::connect_reddit(): logged in to Reddit as %s", self.conf.reddit.auth.user)
         return conn
 
+    def each_coin(self, func, coins=None):
+        """
+        Call func(coin) concurrently for each coin (default: all enabled coins), waiting up to
+        each coin's rpc.fanout_timeout seconds (default 60). Errors are logged.
+        Returns (results, errors) dictionaries by coin
+        """
+
+        coins = list(coins) if coins is not None else sorted(self.coins)
+        timeout = {}
+        for c in coins:
+            rpc = self.conf.coins[c].rpc if hasattr(self.conf.coins[c], 'rpc') else None
+            timeout[c] = rpc.fanout_timeout if rpc and hasattr(rpc, 'fanout_timeout') else 60
+
+        results, errors = ctb_misc.fan_out(func, coins, timeout=timeout)
+        for c in sorted(errors):
+            lg.error("CointipBot::each_coin(%s): %s: %s", getattr(func, '__name__', func), c, errors[c])
+
+        return (results, errors)
+
+    @contextlib.contextmanager
+    def wallet_sessions(self):
+        """
+        Open a wallet session on every coin for the with block, so that wallets unlocked
+        for several withdrawals or new addresses are only locked once, at the end (also on error)
+        """
+
+        opened = []
+        try:
+            for c in sorted(self.coins):
+                self.coins[c].open_session()
+                opened.append(c)
+            yield self
+        finally:
+            for c in opened:
+                self.coins[c].close_session()
+
     def self_checks(self):
         """
         Run self-checks before starting the bot
@@ -145,9 +181,18 @@ class CointipBot(object):
         if not b.is_registered():
             b.register()
 
-        # Ensure (total pending tips) < (CointipBot's balance)
+        # Get CointipBot's tip balance and wallet balance from all coin daemons at once (one batch request per coin)
+        def get_balances(c):
+            balances = self.coins[c].getbalances(_users=[b.name], _minconf=self.conf.coins[c].minconf.givetip, _strict=True, _wallet=True)
+            return (balances[b.name], balances[None])
+        balances, errors = self.each_coin(get_balances)
+        if errors:
+            raise errors[sorted(errors)[0]]
+
+        # Ensure (total pending tips) < (CointipBot's balance), and coin balances are positive
         for c in self.coins:
-            ctb_balance = b.get_balance(coin=c, kind='givetip')
+            ctb_balance, wallet_balance = balances[c]
+
             pending_tips = float(0)
             actions = ctb_action.get_actions(atype='givetip', state='pending', coin=c, ctb=self)
             for a in actions:
@@ -155,11 +200,8 @@ class CointipBot(object):
             if (ctb_balance - pending_tips) < -0.000001:
                 raise Exception("CointipBot::self_checks(): CointipBot's %s balance (%s) < total pending tips (%s)" % (c.upper(), ctb_balance, pending_tips))
 
-        # Ensure coin balances are positive
-        for c in self.coins:
-            b = float(self.coins[c].conn.getbalance())
-            if b < 0:
-                raise Exception("CointipBot::self_checks(): negative balance of %s: %s" % (c, b))
+            if wallet_balance < 0:
+                raise Exception("CointipBot::self_checks(): negative balance of %s: %s" % (c, wallet_balance))
 
         # Ensure user accounts are intact and balances are not negative
         sql = "SELECT username FROM t_users ORDER BY username"
@@ -203,61 +245,65 @@ class CointipBot(object):
             messages = list(ctb_misc.praw_call(self.reddit.inbox.unread, limit=self.conf.reddit.scan.batch_limit))
             messages.reverse()
 
-            # Process messages
-            for m in messages:
-                # Sometimes messages don't have an author (such as 'you are banned from' message)
-                if not m.author:
-                    lg.info("CointipBot::check_inbox(): ignoring msg with no author")
-                    ctb_misc.praw_call(m.mark_read)
-                    continue
+            # Find messages that have been processed already, all at once
+            duplicates = ctb_action.check_actions(msg_ids=[m.id for m in messages], ctb=self)
 
-                lg.info("CointipBot::check_inbox(): %s from %s", "comment" if m.was_comment else "message", m.author.name)
+            # Process messages (keeping wallets unlocked, once needed, until all are done)
+            with self.wallet_sessions():
+                for m in messages:
+                    # Sometimes messages don't have an author (such as 'you are banned from' message)
+                    if not m.author:
+                        lg.info("CointipBot::check_inbox(): ignoring msg with no author")
+                        ctb_misc.praw_call(m.mark_read)
+                        continue
 
-                # Ignore duplicate messages (sometimes Reddit fails to mark messages as read)
-                if ctb_action.check_action(msg_id=m.id, ctb=self):
-                    lg.warning("CointipBot::check_inbox(): duplicate action detected (msg.id %s), ignoring", m.id)
-                    ctb_misc.praw_call(m.mark_read)
-                    continue
+                    lg.info("CointipBot::check_inbox(): %s from %s", "comment" if m.was_comment else "message", m.author.name)
 
-                # Ignore self messages
-                if m.author and m.author.name.lower() == self.conf.reddit.auth.user.lower():
-                    lg.debug("CointipBot::check_inbox(): ignoring message from self")
-                    ctb_misc.praw_call(m.mark_read)
-                    continue
-
-                # Ignore messages from banned users
-                if m.author and self.conf.reddit.banned_users:
-                    lg.debug("CointipBot::check_inbox(): checking whether user '%s' is banned..." % m.author)
-                    u = ctb_user.CtbUser(name = m.author.name, redditobj = m.author, ctb = self)
-                    if u.banned:
-                        lg.info("CointipBot::check_inbox(): ignoring banned user '%s'" % m.author)
+                    # Ignore duplicate messages (sometimes Reddit fails to mark messages as read)
+                    if m.id in duplicates:
+                        lg.warning("CointipBot::check_inbox(): duplicate action detected (msg.id %s), ignoring", m.id)
                         ctb_misc.praw_call(m.mark_read)
                         continue
 
-                action = None
-                if m.was_comment:
-                    # Attempt to evaluate as comment / mention
-                    action = ctb_action.eval_comment(m, self)
-                else:
-                    # Attempt to evaluate as inbox message
-                    action = ctb_action.eval_message(m, self)
-
-                # Perform action, if found
-                if action:
-                    lg.info("CointipBot::check_inbox(): %s from %s (m.id %s)", action.type, action.u_from.name, m.id)
-                    lg.debug("CointipBot::check_inbox(): message body: <%s>", m.body)
-                    action.do()
-                else:
-                    lg.info("CointipBot::check_inbox(): no match")
-                    if self.conf.reddit.messages.sorry and not m.subject in ['post reply', 'comment reply']:
-                        user = ctb_user.CtbUser(name=m.author.name, redditobj=m.author, ctb=self)
-                        tpl = self.jenv.get_template('didnt-understand.tpl')
-                        msg = tpl.render(user_from=user.name, what='comment' if m.was_comment else 'message', source_link=m.permalink if hasattr(m, 'permalink') else None, ctb=self)
-                        lg.debug("CointipBot::check_inbox(): %s", msg)
-                        user.tell(subj='What?', msg=msg, msgobj=m if not m.was_comment else None)
+                    # Ignore self messages
+                    if m.author and m.author.name.lower() == self.conf.reddit.auth.user.lower():
+                        lg.debug("CointipBot::check_inbox(): ignoring message from self")
+                        ctb_misc.praw_call(m.mark_read)
+                        continue
 
-                # Mark message as read
-                ctb_misc.praw_call(m.mark_read)
+                    # Ignore messages from banned users
+                    if m.author and self.conf.reddit.banned_users:
+                        lg.debug("CointipBot::check_inbox(): checking whether user '%s' is banned..." % m.author)
+                        u = ctb_user.CtbUser(name = m.author.name, redditobj = m.author, ctb = self)
+                        if u.banned:
+                            lg.info("CointipBot::check_inbox(): ignoring banned user '%s'" % m.author)
+                            ctb_misc.praw_call(m.mark_read)
+                            continue
+
+                    action = None
+                    if m.was_comment:
+                        # Attempt to evaluate as comment / mention
+                        action = ctb_action.eval_comment(m, self)
+                    else:
+                        # Attempt to evaluate as inbox message
+                        action = ctb_action.eval_message(m, self)
+
+                    # Perform action, if found
+                    if action:
+                        lg.info("CointipBot::check_inbox(): %s from %s (m.id %s)", action.type, action.u_from.name, m.id)
+                        lg.debug("CointipBot::check_inbox(): message body: <%s>", m.body)
+                        action.do()
+                    else:
+                        lg.info("CointipBot::check_inbox(): no match")
+                        if self.conf.reddit.messages.sorry and not m.subject in ['post reply', 'comment reply']:
+                            user = ctb_user.CtbUser(name=m.author.name, redditobj=m.author, ctb=self)
+                            tpl = self.jenv.get_template('didnt-understand.tpl')
+                            msg = tpl.render(user_from=user.name, what='comment' if m.was_comment else 'message', source_link=m.permalink if hasattr(m, 'permalink') else None, ctb=self)
+                            lg.debug("CointipBot::check_inbox(): %s", msg)
+                            user.tell(subj='What?', msg=msg, msgobj=m if not m.was_comment else None)
+
+                    # Mark message as read
+                    ctb_misc.praw_call(m.mark_read)
 
         except (HTTPError, ConnectionError, Timeout, timeout) as e:
             lg.warning("CointipBot::check_inbox(): Reddit is down (%s), sleeping", e)
@@ -327,46 +373,80 @@ class CointipBot(object):
                 self.conf.reddit.last_processed_comment_time = ctb_misc.get_value(conn=self.db, param0='last_processed_comment_time')
             updated_last_processed_time = 0
 
-            # Fetch comments from subreddits
-            my_comments = ctb_misc.praw_call(self.conf.reddit.subreddits.get_comments, limit=self.conf.reddit.scan.batch_limit)
+            # Comments are passed through stages, cheapest first, so that database
+            # and Reddit lookups are only done for comments containing commands
+            stages = []
 
-            # Match each comment against regex
-            counter = 0
+            # Stage 1: fetch new comments from subreddits
+            t = time.time()
+            my_comments = ctb_misc.praw_call(self.conf.reddit.subreddits.get_comments, limit=self.conf.reddit.scan.batch_limit)
+            comments = []
             for c in my_comments:
                 # Stop processing if old comment reached
                 #lg.debug("check_subreddits(): c.id %s from %s, %s <= %s", c.id, c.subreddit.display_name, c.created_utc, self.conf.reddit.last_processed_comment_time)
                 if c.created_utc <= self.conf.reddit.last_processed_comment_time:
                     lg.debug("CointipBot::check_subreddits(): old comment reached")
                     break
-                counter += 1
+                comments.append(c)
                 if c.created_utc > updated_last_processed_time:
                     updated_last_processed_time = c.created_utc
-
-                # Ignore duplicate comments (may happen when bot is restarted)
-                if ctb_action.check_action(msg_id=c.id, ctb=self):
-                    lg.warning("CointipBot::check_inbox(): duplicate action detected (comment.id %s), ignoring", c.id)
-                    continue
-
-                # Ignore comments from banned users
-                if c.author and self.conf.reddit.banned_users:
-                    lg.debug("CointipBot::check_subreddits(): checking whether user '%s' is banned..." % c.author)
-                    u = ctb_user.CtbUser(name = c.author.name, redditobj = c.author, ctb = self)
-                    if u.banned:
-                        lg.info("CointipBot::check_subreddits(): ignoring banned user '%s'" % c.author)
-                        continue
-
-                # Attempt to evaluate comment
-                action = ctb_action.eval_comment(c, self)
-
-                # Perform action, if found
-                if action:
-                    lg.info("CointipBot::check_subreddits(): %s from %s (%s)", action.type, action.u_from.name, c.id)
-                    lg.debug("CointipBot::check_subreddits(): comment body: <%s>", c.body)
-                    action.do()
-                else:
-                    lg.info("CointipBot::check_subreddits(): no match")
-
-            lg.debug("CointipBot::check_subreddits(): %s comments processed", counter)
+            counter = len(comments)
+            stages.append(('fetch', counter, time.time() - t))
+
+            # Stage 2: keep comments matching action regexes
+            t = time.time()
+            # Matches are kept for stage 5, so comments aren't matched twice
+            matches = {}
+            for c in comments:
+                m = ctb_action.match_command(c.body, self, public=True)
+                if m:
+                    matches[c.id] = m
+            comments = [c for c in comments if matches.has_key(c.id)]
+            stages.append(('regex', len(comments), time.time() - t))
+
+            # Stage 3: ignore duplicate comments (may happen when bot is restarted)
+            t = time.time()
+            duplicates = ctb_action.check_actions(msg_ids=[c.id for c in comments], ctb=self)
+            for c in comments:
+                if c.id in duplicates:
+                    lg.warning("CointipBot::check_subreddits(): duplicate action detected (comment.id %s), ignoring", c.id)
+            comments = [c for c in comments if not c.id in duplicates]
+            stages.append(('dedupe', len(comments), time.time() - t))
+
+            # Stage 4: ignore comments from banned users
+            t = time.time()
+            if self.conf.reddit.banned_users:
+                allowed = []
+                for c in comments:
+                    if c.author:
+                        lg.debug("CointipBot::check_subreddits(): checking whether user '%s' is banned..." % c.author)
+                        u = ctb_user.CtbUser(name = c.author.name, redditobj = c.author, ctb = self)
+                        if u.banned:
+                            lg.info("CointipBot::check_subreddits(): ignoring banned user '%s'" % c.author)
+                            continue
+                    allowed.append(c)
+                comments = allowed
+            stages.append(('banned', len(comments), time.time() - t))
+
+            # Stage 5: evaluate comments and perform actions
+            t = time.time()
+            performed = 0
+            with self.wallet_sessions():
+                for c in comments:
+                    action = ctb_action.eval_comment(c, self, matches=matches[c.id])
+
+                    # Perform action, if found
+                    if action:
+                        lg.info("CointipBot::check_subreddits(): %s from %s (%s)", action.type, action.u_from.name, c.id)
+                        lg.debug("CointipBot::check_subreddits(): comment body: <%s>", c.body)
+                        action.do()
+                        performed += 1
+                    else:
+                        lg.info("CointipBot::check_subreddits(): no match")
+            stages.append(('action', performed, time.time() - t))
+
+            lg.info("CointipBot::check_subreddits(): %s", ", ".join(["%s: %s in %.3fs" % (n, k, d) for n, k, d in stages]))
+            lg.debug("CointipBot::check_subreddits(): %s comments processed (%s rejected by prefilter since start)", counter, self.runtime['counters']['prefilter_rejected'])
             if counter >= self.conf.reddit.scan.batch_limit - 1:
                 lg.warning("CointipBot::check_subreddits(): conf.reddit.scan.batch_limit (%s) was not large enough to process all comments", self.conf.reddit.scan.batch_limit)
 
@@ -516,9 +596,11 @@ class CointipBot(object):
 
         # Coins
         if init_coins:
-            for c in vars(self.conf.coins):
-                if self.conf.coins[c].enabled:
-                    self.coins[c] = ctb_coin.CtbCoin(_conf=self.conf.coins[c])
+            # Connect to coin daemons concurrently
+            coins, errors = self.each_coin(lambda c: ctb_coin.CtbCoin(_conf=self.conf.coins[c]), coins=[c for c in vars(self.conf.coins) if self.conf.coins[c].enabled])
+            if errors:
+                raise errors[sorted(errors)[0]]
+            self.coins.update(coins)
             if not len(self.coins) > 0:
                 lg.error("CointipBot::__init__(): Error: please enable at least one type of coin")
                 sys.exit(1)
@@ -537,6 +619,9 @@ class CointipBot(object):
             self.init_subreddits()
             # Regex for Reddit messages
             ctb_action.init_regex(self)
+            # Remember ids of recently processed messages, so rescans don't need database lookups
+            if init_db:
+                ctb_action.warm_msg_ids(self)
 
         # Self-checks
         if self_checks:
@@ -572,6 +657,13 @@ class CointipBot(object):
             if self.conf.reddit.scan.my_subreddits or hasattr(self.conf.reddit.scan, 'these_subreddits'):
                     self.check_subreddits()
 
+            # Publish stats of users involved in recent actions
+            ctb_stats.flush_user_stats(ctb=self)
+
+            # Balance cache counters
+            for c in sorted(self.coins):
+                lg.debug("CointipBot::main(): %s balance cache: %s hits, %s misses", c, self.coins[c].counters['balance_hits'], self.coins[c].counters['balance_misses'])
+
             # Sleep
             lg.debug("CointipBot::main(): sleeping for %s seconds...", self.conf.misc.times.sleep_seconds)
             time.sleep(self.conf.misc.times.sleep_seconds)
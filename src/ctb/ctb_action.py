@@ -17,11 +17,20 @@
 
 import ctb_user, ctb_misc, ctb_stats
 
-import logging, praw, re, time
+import itertools, logging, praw, re, time
 from random import randint
 
 lg = logging.getLogger('cointipbot')
 
+# Maximum number of groups in one compiled expression (re module limit)
+REGEX_MAX_GROUPS = 100
+
+# Columns of t_action used to construct CtbAction objects
+ACTION_COLUMNS = "type, state, coin, fiat, coin_val, fiat_val, from_user, to_user, to_addr, subreddit, msg_id, msg_link"
+
+# Comparison operators allowed in query filters
+SQL_OPERATORS = ('=', '<>', '<', '<=', '>', '>=')
+
 class CtbActionExc(Exception):
     pass
 
@@ -222,9 +231,18 @@ class CtbAction(object):
         sql = "UPDATE t_action SET state=%s WHERE type=%s AND msg_id=%s"
 
         try:
+            # Read previous state of a tip, to keep t_user_totals in sync
+            old = None
+            if self.type == 'givetip':
+                old = conn.execute("SELECT state, from_user, to_user, coin, fiat, coin_val, fiat_val FROM t_action WHERE type=%s AND msg_id=%s FOR UPDATE", (self.type, self.msg_id)).fetchone()
+
             mysqlexec = conn.execute(sql, (state, self.type, self.msg_id))
             if mysqlexec.rowcount <= 0:
                 raise Exception("query didn't affect any rows")
+
+            if old and (old['state'] == 'completed') != (state == 'completed'):
+                ctb_stats.update_user_totals(ctb=self.ctb, from_user=old['from_user'], to_user=old['to_user'], coin=old['coin'], fiat=old['fiat'],
+                                             coin_val=old['coin_val'], fiat_val=old['fiat_val'], sign=1 if state == 'completed' else -1)
         except Exception as e:
             lg.error("CtbAction::update(%s): error executing query <%s>: %s", state, sql % (state, self.type, self.msg_id))
             raise
@@ -266,6 +284,11 @@ class CtbAction(object):
                      self.msg.permalink if hasattr(self.msg, 'permalink') else None))
             if mysqlexec.rowcount <= 0:
                 raise Exception("query didn't affect any rows")
+            remember_msg_id(self.msg.id, self.ctb)
+
+            if self.type == 'givetip' and state == 'completed':
+                ctb_stats.update_user_totals(ctb=self.ctb, from_user=self.u_from.name, to_user=self.u_to.name if self.u_to else None, coin=self.coin, fiat=self.fiat,
+                                             coin_val=self.coinval, fiat_val=self.fiatval)
         except Exception as e:
             lg.error("CtbAction::save(%s): error executing query <%s>: %s", state, sql % (
                 self.type,
@@ -288,10 +311,18 @@ class CtbAction(object):
         return True
 
     def do(self):
+        """
+        Perform action, with all its database writes in a single transaction
+        """
+
+        with self.ctb.db.unit_of_work():
+            return self.dispatch()
+
+    def dispatch(self):
         """
         Call appropriate function depending on action type
         """
-        lg.debug("> CtbAction::do()")
+        lg.debug("> CtbAction::dispatch()")
 
         if not self.ctb.conf.regex.actions[self.type].enabled:
 	        msg = self.ctb.jenv.get_template('command-disabled.tpl').render(a=self, ctb=self.ctb)
@@ -307,9 +338,9 @@ class CtbAction(object):
 
         if self.type == 'givetip':
             result = self.givetip()
-            ctb_stats.update_user_stats(ctb=self.ctb, username=self.u_from.name)
+            ctb_stats.mark_user_stats(ctb=self.ctb, username=self.u_from.name)
             if self.u_to:
-                ctb_stats.update_user_stats(ctb=self.ctb, username=self.u_to.name)
+                ctb_stats.mark_user_stats(ctb=self.ctb, username=self.u_to.name)
             return result
 
         if self.type == 'history':
@@ -330,7 +361,7 @@ class CtbAction(object):
         if self.type == 'rates':
             return self.rates()
 
-        lg.debug("< CtbAction::do() DONE")
+        lg.debug("< CtbAction::dispatch() DONE")
         return None
 
     def history(self):
@@ -345,11 +376,9 @@ class CtbAction(object):
         limit = int(self.ctb.conf.db.sql.userhistory.limit)
 
         mysqlexec = self.ctb.db.execute(sql_history, (self.u_from.name.lower(), self.u_from.name.lower(), limit))
+        plan = ctb_stats.format_plan(mysqlexec.keys(), self.u_from.name.lower(), self.ctb, compact=True)
         for m in mysqlexec:
-            history_entry = []
-            for k in mysqlexec.keys():
-                history_entry.append(ctb_stats.format_value(m, k, self.u_from.name.lower(), self.ctb, compact=True))
-            history.append(history_entry)
+            history.append([f(m) for f in plan])
 
         # Send message to user
         msg = self.ctb.jenv.get_template('history.tpl').render(history=history, keys=mysqlexec.keys(), limit=limit, a=self, ctb=self.ctb)
@@ -383,9 +412,9 @@ class CtbAction(object):
             for a in actions:
                 a.givetip(is_pending=True)
                 # Update u_from (tip action) stats
-                ctb_stats.update_user_stats(ctb=a.ctb, username=a.u_from.name)
+                ctb_stats.mark_user_stats(ctb=a.ctb, username=a.u_from.name)
             # Update u_from (accept action) stats
-            ctb_stats.update_user_stats(ctb=a.ctb, username=self.u_from.name)
+            ctb_stats.mark_user_stats(ctb=a.ctb, username=self.u_from.name)
             # Save this action
             self.save('completed')
 
@@ -419,7 +448,7 @@ class CtbAction(object):
                 a.update('declined')
 
                 # Update u_from (tip action) stats
-                ctb_stats.update_user_stats(ctb=a.ctb, username=a.u_from.name)
+                ctb_stats.mark_user_stats(ctb=a.ctb, username=a.u_from.name)
 
                 # Respond to tip comment
                 msg = self.ctb.jenv.get_template('confirmation.tpl').render(title='Declined', a=a, ctb=a.ctb, source_link=a.msg.permalink if a.msg else None)
@@ -431,7 +460,7 @@ class CtbAction(object):
                     a.u_from.tell(subj="+tip declined", msg=msg)
 
             # Update u_from (decline action) stats
-            ctb_stats.update_user_stats(ctb=a.ctb, username=self.u_from.name)
+            ctb_stats.mark_user_stats(ctb=a.ctb, username=self.u_from.name)
 
             # Notify self.u_from
             msg = self.ctb.jenv.get_template('pending-tips-declined.tpl').render(user_from=self.u_from.name, ctb=self.ctb)
@@ -468,8 +497,8 @@ class CtbAction(object):
         self.update('expired')
 
         # Update user stats
-        ctb_stats.update_user_stats(ctb=self.ctb, username=self.u_from.name)
-        ctb_stats.update_user_stats(ctb=self.ctb, username=self.u_to.name)
+        ctb_stats.mark_user_stats(ctb=self.ctb, username=self.u_from.name)
+        ctb_stats.mark_user_stats(ctb=self.ctb, username=self.u_to.name)
 
         # Respond to tip comment
         msg = self.ctb.jenv.get_template('confirmation.tpl').render(title='Expired', a=self, ctb=self.ctb, source_link=self.msg.permalink if self.msg else None)
@@ -529,9 +558,10 @@ class CtbAction(object):
                 return False
 
             # Verify balance (unless it's a pending transaction being processed, in which case coins have been already moved to pending acct)
+            # Always ask coin daemon here, bypassing balance cache
             if self.u_to and not is_pending:
                 # Tip to user (requires less confirmations)
-                balance_avail = self.u_from.get_balance(coin=self.coin, kind='givetip')
+                balance_avail = self.u_from.get_balance(coin=self.coin, kind='givetip', strict=True)
                 if not ( balance_avail > self.coinval or abs(balance_avail - self.coinval) < 0.000001 ):
                     msg = self.ctb.jenv.get_template('tip-low-balance.tpl').render(balance=balance_avail, action_name='tip', a=self, ctb=self.ctb)
                     lg.debug("CtbAction::validate(): " + msg)
@@ -540,7 +570,7 @@ class CtbAction(object):
                     return False
             elif self.addr_to:
                 # Tip/withdrawal to address (requires more confirmations)
-                balance_avail = self.u_from.get_balance(coin=self.coin, kind='withdraw')
+                balance_avail = self.u_from.get_balance(coin=self.coin, kind='withdraw', strict=True)
                 balance_need = self.coinval
                 # Add mandatory network transaction fee
                 balance_need += self.ctb.conf.coins[self.coin].txfee
@@ -720,17 +750,16 @@ class CtbAction(object):
         # Info array to pass to template
         info = []
 
-        # Get coin balances
-        for c in sorted(self.ctb.coins):
+        # Get tip balances from all coin daemons at once
+        balances, errors = self.ctb.each_coin(lambda c: self.ctb.coins[c].getbalances(_users=[self.u_from.name], _minconf=self.ctb.conf.coins[c].minconf.givetip)[self.u_from.name.lower()])
+        if errors:
+            lg.error("CtbAction::info(%s): error retrieving coininfo for %s", self.u_from.name, ', '.join(sorted(errors)))
+            raise errors[sorted(errors)[0]]
+        for c in sorted(balances):
             coininfo = ctb_misc.DotDict({})
             coininfo.coin = c
-            try:
-                # Get tip balance
-                coininfo.balance = self.ctb.coins[c].getbalance(_user=self.u_from.name, _minconf=self.ctb.conf.coins[c].minconf.givetip)
-                info.append(coininfo)
-            except Exception as e:
-                lg.error("CtbAction::info(%s): error retrieving %s coininfo: %s", self.u_from.name, c, e)
-                raise
+            coininfo.balance = balances[c]
+            info.append(coininfo)
 
         # Get fiat balances
         fiat_total = 0.0
@@ -926,6 +955,9 @@ def init_regex(ctb):
     actions = ctb.conf.regex.actions
     ctb.runtime['regex'] = []
 
+    # Merged coin/fiat unit expressions, used to avoid expanding templates per coin and fiat
+    units = init_units(ctb)
+
     for a in vars(actions):
         if actions[a].simple:
 
@@ -938,6 +970,8 @@ def init_regex(ctb):
                  'rg_keyword':  0,
                  'rg_address':  0,
                  'rg_to_user':  0,
+                 'rg_coin':     0,
+                 'rg_fiat':     0,
                  'coin':        None,
                  'fiat':        None,
                  'keyword':     None
@@ -957,7 +991,30 @@ def init_regex(ctb):
                 rval1 = rval1.replace('{REGEX_AMOUNT}', ctb.conf.regex.values.amount.regex)
                 rval1 = rval1.replace('{REGEX_KEYWORD}', ctb.conf.regex.values.keywords.regex)
 
-                if actions[a].regex[r].rg_coin > 0:
+                if units and ( actions[a].regex[r].rg_coin > 0 or actions[a].regex[r].rg_fiat > 0 ):
+
+                    # Add a single expression matching any enabled coin/fiat unit;
+                    # matched units are resolved back to coin/fiat by match_units()
+
+                    rval2 = rval1.replace('{REGEX_COIN}', units['coin'])
+                    rval2 = rval2.replace('{REGEX_ADDRESS}', units['address'])
+                    rval2 = rval2.replace('{REGEX_FIAT}', units['fiat'])
+                    entry = ctb_misc.DotDict(
+                        {'regex':           rval2,
+                         'action':          a,
+                         'rg_amount':       actions[a].regex[r].rg_amount,
+                         'rg_keyword':      actions[a].regex[r].rg_keyword,
+                         'rg_address':      actions[a].regex[r].rg_address,
+                         'rg_to_user':      actions[a].regex[r].rg_to_user,
+                         'rg_coin':         actions[a].regex[r].rg_coin,
+                         'rg_fiat':         actions[a].regex[r].rg_fiat,
+                         'coin':            None,
+                         'fiat':            None
+                        })
+                    lg.debug("init_regex(): ADDED %s: %s", entry.action, entry.regex)
+                    ctb.runtime['regex'].append(entry)
+
+                elif actions[a].regex[r].rg_coin > 0:
 
                     for c in sorted(vars(cc)):
 
@@ -984,6 +1041,8 @@ def init_regex(ctb):
                                      'rg_keyword':      actions[a].regex[r].rg_keyword,
                                      'rg_address':      actions[a].regex[r].rg_address,
                                      'rg_to_user':      actions[a].regex[r].rg_to_user,
+                                     'rg_coin':         0,
+                                     'rg_fiat':         0,
                                      'coin':            cc[c].unit,
                                      'fiat':            fiat[f].unit
                                     })
@@ -999,6 +1058,8 @@ def init_regex(ctb):
                                  'rg_keyword':      actions[a].regex[r].rg_keyword,
                                  'rg_address':      actions[a].regex[r].rg_address,
                                  'rg_to_user':      actions[a].regex[r].rg_to_user,
+                                 'rg_coin':         0,
+                                 'rg_fiat':         0,
                                  'coin':            cc[c].unit,
                                  'fiat':            None
                                 })
@@ -1021,6 +1082,8 @@ def init_regex(ctb):
                              'rg_keyword':      actions[a].regex[r].rg_keyword,
                              'rg_address':      actions[a].regex[r].rg_address,
                              'rg_to_user':      actions[a].regex[r].rg_to_user,
+                             'rg_coin':         0,
+                             'rg_fiat':         0,
                              'coin':            None,
                              'fiat':            fiat[f].unit
                             })
@@ -1036,15 +1099,321 @@ def init_regex(ctb):
                          'rg_keyword':      actions[a].regex[r].rg_keyword,
                          'rg_address':      actions[a].regex[r].rg_address,
                          'rg_to_user':      actions[a].regex[r].rg_to_user,
+                         'rg_coin':         0,
+                         'rg_fiat':         0,
                          'coin':            None,
                          'fiat':            None
                         })
                     lg.debug("init_regex(): ADDED %s: %s", entry.action, entry.regex)
                     ctb.runtime['regex'].append(entry)
 
+    # Compile each expression once, so evaluators don't have to re-compile it for every message
+    for entry in ctb.runtime['regex']:
+        entry.rg = re.compile(entry.regex, re.IGNORECASE|re.DOTALL)
+
+    # Literal-token prefilters for messages (all actions) and comments (public actions only)
+    ctb.runtime['prefilter'] = {'message': init_prefilter(ctb, public_only=False),
+                                'comment': init_prefilter(ctb, public_only=True)}
+
+    # Matchers used by iter_matches(); 'loop' engine tries each expression in turn,
+    # 'combined' engine finds the first matching expression in a single pass
+    engine = ctb.conf.regex.engine if hasattr(ctb.conf.regex, 'engine') else 'loop'
+    if not engine in ['loop', 'combined']:
+        raise Exception("init_regex(): invalid conf.regex.engine '%s'" % engine)
+    ctb.runtime['matchers'] = {}
+    for kind, public_only in [('message', False), ('comment', True)]:
+        entries = [r for r in ctb.runtime['regex'] if actions[r.action].public or not public_only]
+        ctb.runtime['matchers'][kind] = {'entries': entries, 'combined': init_combined(entries) if engine == 'combined' else None}
+    lg.debug("init_regex(): using %s engine", engine)
+
     lg.info("< init_regex() DONE (%s expressions)", len(ctb.runtime['regex']))
     return None
 
+def merge_groups(regexes):
+    """
+    Merge single-group expressions such as '(ltc|litecoin)' and '(ppc|peercoin)'
+    into one group, '(ltc|litecoin|ppc|peercoin)', so that group numbering is kept.
+    Returns None if any expression isn't exactly one capturing group.
+    """
+
+    inner = []
+    for r in regexes:
+        try:
+            if not ( r.startswith('(') and r.endswith(')') and re.compile(r).groups == 1 and re.compile(r[1:-1]).groups == 0 ):
+                return None
+        except re.error:
+            return None
+        inner.append(r[1:-1])
+
+    if not inner:
+        return None
+
+    return '(' + '|'.join(inner) + ')'
+
+def init_units(ctb):
+    """
+    Initialize coin/fiat unit lookup in ctb.runtime['units'] and return merged
+    coin unit, coin address, and fiat unit expressions. Returns None if these
+    can't be merged, in which case templates are expanded per coin and fiat.
+    """
+    lg.debug("> init_units()")
+
+    cc = ctb.conf.coins
+    fiat = ctb.conf.fiat
+    flags = re.IGNORECASE|re.DOTALL
+
+    coins = [cc[c] for c in sorted(vars(cc)) if cc[c].enabled]
+    fiats = [fiat[f] for f in sorted(vars(fiat)) if fiat[f].enabled]
+
+    ctb.runtime['units'] = {
+        'coin':     [(c.unit, re.compile('(?:%s)\\Z' % c.regex.units, flags), re.compile('(?:%s)\\Z' % c.regex.address, flags)) for c in coins],
+        'fiat':     [(f.unit, re.compile('(?:%s)\\Z' % f.regex.units, flags), None) for f in fiats],
+        'lookup':   {} }
+
+    merged = {'coin':       merge_groups([c.regex.units for c in coins]),
+              'address':    merge_groups([c.regex.address for c in coins]),
+              'fiat':       merge_groups([f.regex.units for f in fiats])}
+
+    for k in merged:
+        if not merged[k]:
+            lg.warning("init_units(): can't merge %s expressions, expanding templates per coin and fiat", k)
+            return None
+
+    lg.debug("< init_units() DONE")
+    return merged
+
+def resolve_units(ctb, kind, text):
+    """
+    Return tuple of coin or fiat units (kind is 'coin' or 'fiat') matching matched text,
+    such as ('ltc',) for 'Litecoins', in the same order as per-coin expansion
+    """
+
+    key = (kind, text.lower())
+    lookup = ctb.runtime['units']['lookup']
+
+    if not lookup.has_key(key):
+        lookup[key] = tuple([unit for unit, rg_units, rg_address in ctb.runtime['units'][kind] if rg_units.match(text)])
+
+    return lookup[key]
+
+def match_units(r, m, ctb):
+    """
+    Return (coin, fiat) tuple for match m of regex entry r, or None
+    if matched address doesn't belong to any coin matching matched unit
+    """
+
+    coin = r.coin
+    fiat = r.fiat
+
+    if r.rg_coin > 0:
+        # Several coins may share a unit token, try each of them (first wins)
+        coins = resolve_units(ctb, 'coin', m.group(r.rg_coin))
+        if r.rg_address > 0:
+            addr_rgs = dict([(unit, rg_address) for unit, rg_units, rg_address in ctb.runtime['units']['coin']])
+            coins = [c for c in coins if addr_rgs[c].match(m.group(r.rg_address))]
+        if not coins:
+            return None
+        coin = coins[0]
+
+    if r.rg_fiat > 0:
+        fiats = resolve_units(ctb, 'fiat', m.group(r.rg_fiat))
+        if not fiats:
+            return None
+        fiat = fiats[0]
+
+    return (coin, fiat)
+
+def regex_prefix(ctb, template):
+    """
+    Return leading command-token part of a regex template, i.e. everything before
+    the first whitespace group or value placeholder (such as '(\\+)(withdraw)')
+    """
+
+    rval = template.replace('{REGEX_TIP_INIT}', ctb.conf.regex.values.tip_init.regex)
+
+    cut = len(rval)
+    for token in ['(\\s+)', '{REGEX_']:
+        i = rval.find(token)
+        if i > -1 and i < cut:
+            cut = i
+
+    return rval[:cut]
+
+def init_prefilter(ctb, public_only=False):
+    """
+    Build a single compiled alternation of command tokens ('+' followed by bot name
+    or action keyword) that any matching message body must contain.
+    Returns None if a prefilter can't be derived from configured actions.
+    """
+    lg.debug("> init_prefilter(%s)", public_only)
+
+    actions = ctb.conf.regex.actions
+    prefixes = []
+
+    for a in sorted(vars(actions)):
+        if public_only and not actions[a].public:
+            continue
+
+        if actions[a].simple:
+            templates = [actions[a].regex]
+        else:
+            templates = [actions[a].regex[r].value for r in sorted(vars(actions[a].regex))]
+
+        for t in templates:
+            prefix = regex_prefix(ctb, t)
+            if not prefix:
+                lg.warning("init_prefilter(): can't derive command token from <%s>, prefilter disabled", t)
+                return None
+            if not prefix in prefixes:
+                prefixes.append(prefix)
+
+    if not prefixes:
+        lg.debug("< init_prefilter() DONE (no actions)")
+        return None
+
+    # Factor out leading '+' so that the scan can skip straight to '+' characters
+    if all([p.startswith('(\\+)') for p in prefixes]):
+        pf = '\\+(?:' + '|'.join(['(?:%s)' % p[len('(\\+)'):] for p in prefixes]) + ')'
+    else:
+        pf = '|'.join(['(?:%s)' % p for p in prefixes])
+
+    lg.debug("< init_prefilter() DONE (%s)", pf)
+    return re.compile(pf, re.IGNORECASE|re.DOTALL)
+
+def is_candidate(body, ctb, public=True):
+    """
+    Return True if body passes the literal-token prefilter, i.e. it may contain a command.
+    Rejected bodies are counted in ctb.runtime['counters']['prefilter_rejected'].
+    """
+
+    pf = ctb.runtime['prefilter'].get('comment' if public else 'message')
+    if not pf or pf.search(body):
+        return True
+
+    ctb.runtime['counters']['prefilter_rejected'] += 1
+    return False
+
+def init_combined(entries):
+    """
+    Join regex entries into alternations of lookaheads, so that a single match()
+    call returns the first entry (in list order) matching anywhere in the body.
+    Alternations are split into chunks to stay below the re module group limit.
+    Returns a list of (compiled expression, {group name: (entry index, group offset)}).
+    """
+    lg.debug("> init_combined(%s entries)", len(entries))
+
+    chunks = []
+    parts = []
+    members = {}
+    groups = 0
+
+    for i in range(len(entries)):
+        r = entries[i]
+        n = r.rg.groups + 1
+        if parts and groups + n > REGEX_MAX_GROUPS:
+            chunks.append((re.compile('\\A(?:' + '|'.join(parts) + ')', re.IGNORECASE|re.DOTALL), members))
+            parts = []
+            members = {}
+            groups = 0
+
+        # Entry's own groups follow its named group, so group k of entry is group (offset + k)
+        name = 'r%d' % i
+        members[name] = (i, groups + 1)
+        parts.append('(?=.*?(?P<%s>%s))' % (name, r.regex))
+        groups += n
+
+    if parts:
+        chunks.append((re.compile('\\A(?:' + '|'.join(parts) + ')', re.IGNORECASE|re.DOTALL), members))
+
+    lg.debug("< init_combined() DONE (%s expressions)", len(chunks))
+    return chunks
+
+class CtbMatch(object):
+    """
+    Match of a combined expression, seen as a match of one of its entries
+    """
+
+    def __init__(self, m, offset):
+        self.m = m
+        self.offset = offset
+
+    def group(self, n=0):
+        return self.m.group(self.offset + n)
+
+def cap_body(body, ctb):
+    """
+    Return the part of body that is considered for matching
+    (first conf.regex.guard.max_length characters)
+    """
+
+    if not hasattr(ctb.conf.regex, 'guard'):
+        return body
+
+    if len(body) > ctb.conf.regex.guard.max_length:
+        lg.debug("cap_body(): body length %s > %s, truncating", len(body), ctb.conf.regex.guard.max_length)
+        return body[:ctb.conf.regex.guard.max_length]
+
+    return body
+
+def command_windows(body, ctb, public=False):
+    """
+    Return list of body slices to match expressions against: windows of
+    conf.regex.guard.window_length characters starting at each command token
+    found by the prefilter (overlapping windows are merged)
+    """
+
+    pf = ctb.runtime['prefilter'].get('comment' if public else 'message')
+    if not hasattr(ctb.conf.regex, 'guard') or not pf:
+        return [body]
+
+    length = ctb.conf.regex.guard.window_length
+    windows = []
+    for t in pf.finditer(body):
+        if windows and t.start() <= windows[-1][1]:
+            windows[-1][1] = t.start() + length
+        else:
+            windows.append([t.start(), t.start() + length])
+
+    return [body[start:end] for start, end in windows]
+
+def iter_matches(body, ctb, public=False):
+    """
+    Yield (r, m) for each regex entry r matching body, in runtime['regex'] order,
+    where m.group(n) returns group n of r.regex
+    """
+
+    matcher = ctb.runtime['matchers']['comment' if public else 'message']
+    entries = matcher['entries']
+    windows = command_windows(body, ctb, public)
+    start = 0
+
+    if matcher['combined']:
+        # Find first matching entry in each window, keep the earliest entry
+        found = None
+        for w in windows:
+            for rg, members in matcher['combined']:
+                m = rg.match(w)
+                if m:
+                    i, offset = members[m.lastgroup]
+                    if not found or i < found[0]:
+                        found = (i, CtbMatch(m, offset))
+                    break
+        if not found:
+            return
+        yield entries[found[0]], found[1]
+        # Caller wants more matches (e.g. matched coin and address didn't agree):
+        # continue with the same entry at other positions, then remaining entries
+        start = found[0]
+
+    # Yield every position each entry matches at, as per-coin expressions would
+    # find a later position where an earlier one is rejected by match_units()
+    for r in entries[start:]:
+        for w in windows:
+            m = r.rg.search(w)
+            while m:
+                yield r, m
+                m = r.rg.search(w, m.start() + 1)
+
 def eval_message(msg, ctb):
     """
     Evaluate message body and return a CtbAction
@@ -1052,120 +1421,210 @@ def eval_message(msg, ctb):
     """
     lg.debug("> eval_message()")
 
-    body = msg.body
-    for r in ctb.runtime['regex']:
+    body = cap_body(msg.body, ctb)
+    if not is_candidate(body, ctb, public=False):
+        lg.debug("< eval_message() DONE (rejected by prefilter)")
+        return None
 
-        # Attempt a match
-        rg = re.compile(r.regex, re.IGNORECASE|re.DOTALL)
-        #lg.debug("matching '%s' with '%s'", msg.body, r.regex)
-        m = rg.search(body)
+    for r, m in iter_matches(body, ctb, public=False):
+        # Match found
+        lg.debug("eval_message(): match found")
 
-        if m:
-            # Match found
-            lg.debug("eval_message(): match found")
+        # Determine coin and fiat
+        units = match_units(r, m, ctb)
+        if not units:
+            lg.debug("eval_message(): inconsistent coin/address, skipping")
+            continue
+        coin, fiat = units
+
+        # Extract matched fields into variables
+        u_from = msg.author
+        u_to = m.group(r.rg_to_user)[1:] if r.rg_to_user > 0 else None
+        to_addr = m.group(r.rg_address) if r.rg_address > 0 else None
+        amount = m.group(r.rg_amount) if r.rg_amount > 0 else None
+        keyword = m.group(r.rg_keyword) if r.rg_keyword > 0 else None
+
+        # Ignore 'givetip' without u_to and without to_addr
+        if r.action == 'givetip' and not u_to and not to_addr:
+            lg.warning("eval_message(): givetip: no to_user and no to_addr specified, ignoring")
+            return None
+
+        # Return CtbAction instance with given variables
+        lg.debug("eval_message(): creating action %s: from_user=%s, to_addr=%s, amount=%s, coin=%s, fiat=%s" % (r.action, u_from, to_addr, amount, coin, fiat))
+        try:
+            action = CtbAction(
+                atype=r.action,
+                msg=msg,
+                from_user=u_from,
+                to_user=u_to,
+                to_addr=to_addr,
+                coin=coin,
+                coin_val=amount if not fiat else None,
+                fiat=fiat,
+                fiat_val=amount if fiat else None,
+                keyword=keyword,
+                ctb=ctb)
+            return action
+        except CtbActionExc as e:
+            lg.warning("eval_message(): " + str(e))
+            return None
 
-            # Extract matched fields into variables
-            u_from = msg.author
-            u_to = m.group(r.rg_to_user)[1:] if r.rg_to_user > 0 else None
-            to_addr = m.group(r.rg_address) if r.rg_address > 0 else None
-            amount = m.group(r.rg_amount) if r.rg_amount > 0 else None
-            keyword = m.group(r.rg_keyword) if r.rg_keyword > 0 else None
+    # No match found
+    lg.debug("eval_message(): no match found")
+    return None
 
-            # Ignore 'givetip' without u_to and without to_addr
-            if r.action == 'givetip' and not u_to and not to_addr:
-                lg.warning("eval_message(): givetip: no to_user and no to_addr specified, ignoring")
-                return None
+def match_command(body, ctb, public=True):
+    """
+    Return iterator over (r, m) matches of body as returned by iter_matches(),
+    or None if body doesn't match any of the action regexes. The first match is
+    found here; pass the iterator to eval_comment() so it isn't matched again.
+    """
 
-            # Return CtbAction instance with given variables
-            lg.debug("eval_message(): creating action %s: from_user=%s, to_addr=%s, amount=%s, coin=%s, fiat=%s" % (r.action, u_from, to_addr, amount, r.coin, r.fiat))
-            try:
-                action = CtbAction(
-                    atype=r.action,
-                    msg=msg,
-                    from_user=u_from,
-                    to_user=u_to,
-                    to_addr=to_addr,
-                    coin=r.coin,
-                    coin_val=amount if not r.fiat else None,
-                    fiat=r.fiat,
-                    fiat_val=amount if r.fiat else None,
-                    keyword=keyword,
-                    ctb=ctb)
-                return action
-            except CtbActionExc as e:
-                lg.warning("eval_message(): " + str(e))
-                return None
+    body = cap_body(body, ctb)
+    if not is_candidate(body, ctb, public=public):
+        return None
+
+    matches = iter_matches(body, ctb, public=public)
+    for first in matches:
+        return itertools.chain([first], matches)
 
-    # No match found
-    lg.debug("eval_message(): no match found")
     return None
 
-def eval_comment(comment, ctb):
+def eval_comment(comment, ctb, matches=None):
     """
-    Evaluate comment body and return a CtbAction object if successful
+    Evaluate comment body and return a CtbAction object if successful.
+    matches is the result of match_command() for comment body, if already known.
     """
     lg.debug("> eval_comment()")
 
-    body = comment.body
-    for r in ctb.runtime['regex']:
-
-        # Skip non-public actions
-        if not ctb.conf.regex.actions[r.action].public:
+    if matches is None:
+        body = cap_body(comment.body, ctb)
+        if not is_candidate(body, ctb, public=True):
+            lg.debug("< eval_comment() DONE (rejected by prefilter)")
+            return None
+        matches = iter_matches(body, ctb, public=True)
+
+    for r, m in matches:
+        # Match found
+        lg.debug("eval_comment(): match found")
+
+        # Determine coin and fiat
+        units = match_units(r, m, ctb)
+        if not units:
+            lg.debug("eval_comment(): inconsistent coin/address, skipping")
             continue
-
-        # Attempt a match
-        rg = re.compile(r.regex, re.IGNORECASE|re.DOTALL)
-        #lg.debug("eval_comment(): matching '%s' with <%s>", comment.body, r.regex)
-        m = rg.search(body)
-
-        if m:
-            # Match found
-            lg.debug("eval_comment(): match found")
-
-            # Extract matched fields into variables
-            u_to = m.group(r.rg_to_user)[1:] if r.rg_to_user > 0 else None
-            to_addr = m.group(r.rg_address) if r.rg_address > 0 else None
-            amount = m.group(r.rg_amount) if r.rg_amount > 0 else None
-            keyword = m.group(r.rg_keyword) if r.rg_keyword > 0 else None
-
-            # If no destination mentioned, find parent submission's author
-            if not u_to and not to_addr:
-                # set u_to to author of parent comment
-                u_to = ctb_misc.reddit_get_parent_author(comment, ctb.reddit, ctb)
-                if not u_to:
-                    # couldn't determine u_to, giving up
-                    lg.warning("eval_comment(): couldn't determine u_to, giving up")
-                    return None
-
-            # Check if from_user == to_user
-            if u_to and comment.author.name.lower() == u_to.lower():
-                lg.warning("eval_comment(): comment.author.name == u_to, ignoring comment", comment.author.name)
+        coin, fiat = units
+
+        # Extract matched fields into variables
+        u_to = m.group(r.rg_to_user)[1:] if r.rg_to_user > 0 else None
+        to_addr = m.group(r.rg_address) if r.rg_address > 0 else None
+        amount = m.group(r.rg_amount) if r.rg_amount > 0 else None
+        keyword = m.group(r.rg_keyword) if r.rg_keyword > 0 else None
+
+        # If no destination mentioned, find parent submission's author
+        if not u_to and not to_addr:
+            # set u_to to author of parent comment
+            u_to = ctb_misc.reddit_get_parent_author(comment, ctb.reddit, ctb)
+            if not u_to:
+                # couldn't determine u_to, giving up
+                lg.warning("eval_comment(): couldn't determine u_to, giving up")
                 return None
 
-            # Return CtbAction instance with given variables
-            lg.debug("eval_comment(): creating action %s: to_user=%s, to_addr=%s, amount=%s, coin=%s, fiat=%s" % (r.action, u_to, to_addr, amount, r.coin, r.fiat))
-            try:
-                action = CtbAction(
-                    atype=r.action,
-                    msg=comment,
-                    to_user=u_to,
-                    to_addr=to_addr,
-                    coin=r.coin,
-                    coin_val=amount if not r.fiat else None,
-                    fiat=r.fiat,
-                    fiat_val=amount if r.fiat else None,
-                    keyword=keyword,
-                    subr=comment.subreddit,
-                    ctb=ctb)
-                return action
-            except CtbActionExc as e:
-                lg.warning("eval_comment(): " + str(e))
-                return None
+        # Check if from_user == to_user
+        if u_to and comment.author.name.lower() == u_to.lower():
+            lg.warning("eval_comment(): comment.author.name == u_to, ignoring comment", comment.author.name)
+            return None
+
+        # Return CtbAction instance with given variables
+        lg.debug("eval_comment(): creating action %s: to_user=%s, to_addr=%s, amount=%s, coin=%s, fiat=%s" % (r.action, u_to, to_addr, amount, coin, fiat))
+        try:
+            action = CtbAction(
+                atype=r.action,
+                msg=comment,
+                to_user=u_to,
+                to_addr=to_addr,
+                coin=coin,
+                coin_val=amount if not fiat else None,
+                fiat=fiat,
+                fiat_val=amount if fiat else None,
+                keyword=keyword,
+                subr=comment.subreddit,
+                ctb=ctb)
+            return action
+        except CtbActionExc as e:
+            lg.warning("eval_comment(): " + str(e))
+            return None
 
     # No match found
     lg.debug("< eval_comment() DONE (no match)")
     return None
 
+def action_filters(atype=None, state=None, coin=None, msg_id=None, created_utc=None, from_user=None, to_user=None, subr=None, is_pending=False):
+    """
+    Return a list of (column, operator, value) filters for given action attributes.
+    created_utc can be a value or a string prefixed with an operator, such as '< 1389000000'.
+    """
+
+    filters = []
+    if atype:
+        filters.append(('type', '=', atype))
+    if state:
+        filters.append(('state', '=', state))
+    if coin:
+        filters.append(('coin', '=', coin))
+    if msg_id:
+        filters.append(('msg_id', '=', msg_id))
+    if created_utc:
+        op, value = parse_operator(created_utc)
+        filters.append(('created_utc', op, value))
+    if from_user:
+        filters.append(('from_user', '=', from_user.lower()))
+    if to_user:
+        filters.append(('to_user', '=', to_user.lower()))
+    if subr:
+        filters.append(('subreddit', '=', subr))
+    if is_pending:
+        filters.append(('state', '<>', 'pending'))
+
+    return filters
+
+def parse_operator(expr):
+    """
+    Split expression such as '< 1389000000' into operator and numeric value
+    (int if it's a whole number, such as '< 1389000000.0', else float).
+    Expressions without an operator are compared for equality.
+    """
+
+    expr = str(expr).strip()
+    op = '='
+    for o in sorted(SQL_OPERATORS, key=len, reverse=True):
+        if expr.startswith(o):
+            op = o
+            expr = expr[len(o):].strip()
+            break
+
+    value = float(expr)
+    return (op, int(value) if value == int(value) else value)
+
+def build_query(columns, filters, ctb, suffix=''):
+    """
+    Return (sql, params) to select given columns from t_action with given filters.
+    Statement text only depends on which filters are set, and is cached in ctb.runtime['sql'].
+    """
+
+    key = (columns, tuple([(c, op) for c, op, v in filters]), suffix)
+    if not ctb.runtime['sql'].has_key(key):
+        sql = "SELECT " + columns + " FROM t_action"
+        if filters:
+            for c, op, v in filters:
+                if not op in SQL_OPERATORS:
+                    raise Exception("build_query(): invalid operator %s" % op)
+            sql += " WHERE " + " AND ".join(["%s %s %%s" % (c, op) for c, op, v in filters])
+        ctb.runtime['sql'][key] = sql + suffix
+        lg.debug("build_query(): new query <%s>", ctb.runtime['sql'][key])
+
+    return (ctb.runtime['sql'][key], [v for c, op, v in filters])
+
 def check_action(atype=None, state=None, coin=None, msg_id=None, created_utc=None, from_user=None, to_user=None, subr=None, ctb=None, is_pending=False):
     """
     Return True if action with given attributes exists in database
@@ -1173,33 +1632,12 @@ def check_action(atype=None, state=None, coin=None, msg_id=None, created_utc=Non
     lg.debug("> check_action(%s)", atype)
 
     # Build SQL query
-    sql = "SELECT * FROM t_action"
-    sql_terms = []
-    if atype or state or coin or msg_id or created_utc or from_user or to_user or subr or is_pending:
-        sql += " WHERE "
-        if atype:
-            sql_terms.append("type = '%s'" % atype)
-        if state:
-            sql_terms.append("state = '%s'" % state)
-        if coin:
-            sql_terms.append("coin = '%s'" % coin)
-        if msg_id:
-            sql_terms.append("msg_id = '%s'" % msg_id)
-        if created_utc:
-            sql_terms.append("created_utc = %s" % created_utc)
-        if from_user:
-            sql_terms.append("from_user = '%s'" % from_user.lower())
-        if to_user:
-            sql_terms.append("to_user = '%s'" % to_user.lower())
-        if subr:
-            sql_terms.append("subreddit = '%s'" % subr)
-        if is_pending:
-            sql_terms.append("state <> 'pending'")
-        sql += ' AND '.join(sql_terms)
+    filters = action_filters(atype=atype, state=state, coin=coin, msg_id=msg_id, created_utc=created_utc, from_user=from_user, to_user=to_user, subr=subr, is_pending=is_pending)
+    sql, params = build_query("1", filters, ctb, suffix=" LIMIT 1")
 
     try:
-        lg.debug("check_action(): <%s>", sql)
-        mysqlexec = ctb.db.execute(sql)
+        lg.debug("check_action(): <%s> %s", sql, params)
+        mysqlexec = ctb.db.execute(sql, params)
         if mysqlexec.rowcount <= 0:
             lg.debug("< check_action() DONE (no)")
             return False
@@ -1207,12 +1645,85 @@ def check_action(atype=None, state=None, coin=None, msg_id=None, created_utc=Non
             lg.debug("< check_action() DONE (yes)")
             return True
     except Exception as e:
-        lg.error("check_action(): error executing <%s>: %s", sql, e)
+        lg.error("check_action(): error executing <%s> %s: %s", sql, params, e)
         raise
 
     lg.warning("< check_action() DONE (should not get here)")
     return None
 
+def remember_msg_id(msg_id, ctb):
+    """
+    Add msg_id to the in-memory set of recent msg_ids known to have an action
+    in database (least recently used entries are dropped first)
+    """
+
+    if not hasattr(ctb.conf.reddit.scan, 'recent_msg_ids') or not ctb.conf.reddit.scan.recent_msg_ids > 0:
+        return None
+
+    recent = ctb.runtime['recent_msg_ids']
+    if recent.has_key(msg_id):
+        del recent[msg_id]
+    recent[msg_id] = True
+
+    while len(recent) > ctb.conf.reddit.scan.recent_msg_ids:
+        recent.popitem(last=False)
+
+    return True
+
+def warm_msg_ids(ctb):
+    """
+    Fill the in-memory set of recent msg_ids from the most recent actions in database,
+    so that rescans after a restart don't have to query database either
+    """
+    lg.debug("> warm_msg_ids()")
+
+    if not hasattr(ctb.conf.reddit.scan, 'recent_msg_ids') or not ctb.conf.reddit.scan.recent_msg_ids > 0:
+        return 0
+    if len(ctb.runtime['recent_msg_ids']) > 0:
+        # Already filled by a previous CointipBot instance in this process
+        return 0
+
+    sql = "SELECT msg_id FROM t_action ORDER BY created_utc DESC LIMIT %s"
+    msg_ids = [m['msg_id'] for m in ctb.db.execute(sql, (ctb.conf.reddit.scan.recent_msg_ids))]
+
+    # Oldest first, so that most recent ones are dropped last
+    for msg_id in reversed(msg_ids):
+        remember_msg_id(msg_id, ctb)
+
+    lg.debug("< warm_msg_ids() DONE (%s msg_ids)", len(msg_ids))
+    return len(msg_ids)
+
+def check_actions(msg_ids=None, ctb=None):
+    """
+    Return a set of msg_ids (out of given list) that already have an action in database.
+    Recent msg_ids are looked up in memory, the rest with a single query.
+    """
+    lg.debug("> check_actions(%s msg_ids)", len(msg_ids))
+
+    found = set()
+    unknown = []
+
+    recent = ctb.runtime['recent_msg_ids']
+    for i in msg_ids:
+        if recent.has_key(i):
+            found.add(i)
+            remember_msg_id(i, ctb)
+        elif not i in found and not i in unknown:
+            unknown.append(i)
+
+    if unknown:
+        sql = "SELECT msg_id FROM t_action WHERE msg_id IN (" + ", ".join(["%s"] * len(unknown)) + ")"
+        try:
+            for m in ctb.db.execute(sql, unknown):
+                found.add(m['msg_id'])
+                remember_msg_id(m['msg_id'], ctb)
+        except Exception as e:
+            lg.error("check_actions(): error executing <%s>: %s", sql, e)
+            raise
+
+    lg.debug("< check_actions() DONE (%s found, %s queried)", len(found), len(unknown))
+    return found
+
 def get_actions(atype=None, state=None, coin=None, msg_id=None, created_utc=None, from_user=None, to_user=None, subr=None, ctb=None):
     """
     Return an array of CtbAction objects from database with given attributes
@@ -1220,33 +1731,14 @@ def get_actions(atype=None, state=None, coin=None, msg_id=None, created_utc=None
     lg.debug("> get_actions(%s)", atype)
 
     # Build SQL query
-    sql = "SELECT * FROM t_action"
-    sql_terms = []
-    if atype or state or coin or msg_id or created_utc or from_user or to_user or subr:
-        sql += " WHERE "
-        if atype:
-            sql_terms.append("type = '%s'" % atype)
-        if state:
-            sql_terms.append("state = '%s'" % state)
-        if coin:
-            sql_terms.append("coin = '%s'" % coin)
-        if msg_id:
-            sql_terms.append("msg_id = '%s'" % msg_id)
-        if created_utc:
-            sql_terms.append("created_utc %s" % created_utc)
-        if from_user:
-            sql_terms.append("from_user = '%s'" % from_user.lower())
-        if to_user:
-            sql_terms.append("to_user = '%s'" % to_user.lower())
-        if subr:
-            sql_terms.append("subreddit = '%s'" % subr)
-        sql += ' AND '.join(sql_terms)
+    filters = action_filters(atype=atype, state=state, coin=coin, msg_id=msg_id, created_utc=created_utc, from_user=from_user, to_user=to_user, subr=subr)
+    sql, params = build_query(ACTION_COLUMNS, filters, ctb)
 
     while True:
         try:
             r = []
-            lg.debug("get_actions(): <%s>", sql)
-            mysqlexec = ctb.db.execute(sql)
+            lg.debug("get_actions(): <%s> %s", sql, params)
+            mysqlexec = ctb.db.execute(sql, params)
 
             if mysqlexec.rowcount <= 0:
                 lg.debug("< get_actions() DONE (no)")
@@ -1287,7 +1779,7 @@ def get_actions(atype=None, state=None, coin=None, msg_id=None, created_utc=None
             return r
 
         except Exception as e:
-            lg.error("get_actions(): error executing <%s>: %s", sql, e)
+            lg.error("get_actions(): error executing <%s> %s: %s", sql, params, e)
             raise
 
     lg.warning("< get_actions() DONE (should not get here)")
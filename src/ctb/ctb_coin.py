@@ -15,12 +15,35 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import logging, re, time
-from pifkoin.bitcoind import Bitcoind, BitcoindException
-from httplib import CannotSendRequest
+import ctb_misc, ctb_rpc
+
+import atexit, contextlib, logging, re, threading, time
+from ctb_rpc import CtbRpcException
 
 lg = logging.getLogger('cointipbot')
 
+# Maximum number of calls sent to coin daemon in one batch request
+RPC_BATCH_SIZE = 100
+
+# Wallet is unlocked again if it would lock itself within this many seconds
+WALLET_UNLOCK_MARGIN = 5
+
+# Error code returned by walletpassphrase when wallet is already unlocked
+WALLET_ALREADY_UNLOCKED = -17
+
+# Latest CtbCoin instance by coin name, whose wallet is locked on shutdown
+exit_coins = {}
+
+def lock_wallets():
+    """
+    Lock wallets of latest CtbCoin instances (registered with atexit once)
+    """
+
+    for coin in exit_coins.values():
+        coin.lock_wallet()
+
+atexit.register(lock_wallets)
+
 class CtbCoin(object):
     """
     Coin class for cointip bot
@@ -28,6 +51,13 @@ class CtbCoin(object):
 
     conn = None
     conf = None
+    limiter = None
+    batch_ok = True
+    balances = None
+    balance_ttl = 0
+    counters = None
+    sessions = 0
+    unlocked_until = 0
 
     def __init__(self, _conf = None):
         """
@@ -40,24 +70,174 @@ class CtbCoin(object):
 
         self.conf = _conf
 
+        # limit rate of calls to coin daemon, if configured
+        if hasattr(self.conf, 'ratelimit'):
+            self.limiter = ctb_misc.TokenBucket(rate=self.conf.ratelimit.rate, burst=self.conf.ratelimit.burst)
+
+        # cache of balances by (user, minconf), kept for balance_ttl seconds
+        self.balances = {}
+        self.balance_ttl = self.conf.balance_ttl if hasattr(self.conf, 'balance_ttl') else 10
+        self.balance_lock = threading.Lock()
+        self.counters = {'balance_hits': 0, 'balance_misses': 0}
+
+        # wallet stays unlocked for up to wallet_unlock_seconds while a wallet session is open
+        self.wallet_unlock_seconds = self.conf.wallet_unlock_seconds if hasattr(self.conf, 'wallet_unlock_seconds') else 30
+        self.wallet_lock = threading.RLock()
+
         # connect to coin daemon
         try:
             lg.debug("CtbCoin::__init__(): connecting to %s...", self.conf.name)
-            self.conn = Bitcoind(self.conf.config_file, rpcserver=self.conf.config_rpcserver)
-        except BitcoindException as e:
+            rpc = self.conf.rpc if hasattr(self.conf, 'rpc') else None
+            self.conn = ctb_rpc.CtbRpc(self.conf.config_file, rpcserver=self.conf.config_rpcserver,
+                                       rpcport=self.conf.config_rpcport if hasattr(self.conf, 'config_rpcport') else None,
+                                       pool_size=rpc.pool_size if rpc and hasattr(rpc, 'pool_size') else 2,
+                                       timeout=rpc.timeout if rpc and hasattr(rpc, 'timeout') else 30,
+                                       retries=rpc.retries if rpc and hasattr(rpc, 'retries') else 3)
+        except Exception as e:
             lg.error("CtbCoin::__init__(): error connecting to %s using %s: %s", self.conf.name, self.conf.config_file, e)
             raise
 
         lg.info("CtbCoin::__init__():: connected to %s", self.conf.name)
-        time.sleep(0.5)
 
         # set transaction fee
         lg.info("Setting tx fee of %f", self.conf.txfee)
-        self.conn.settxfee(self.conf.txfee)
+        self.rpc('settxfee', self.conf.txfee)
+
+        # make sure wallet isn't left unlocked on shutdown, replacing instance created before an error
+        # (whose wallet is locked now if it was left unlocked)
+        if hasattr(self.conf, 'walletpassphrase'):
+            old = exit_coins.get(self.conf.name)
+            exit_coins[self.conf.name] = self
+            if old:
+                old.lock_wallet()
+
+    def wait(self, method):
+        """
+        Wait if the configured call rate is exceeded
+        """
+
+        if self.limiter:
+            waited = self.limiter.acquire()
+            if waited > 0.0:
+                lg.debug("CtbCoin::wait(%s): waited %.3fs (%.3fs total)", method, waited, self.limiter.waited)
+
+    def rpc(self, method, *args):
+        """
+        Call method on coin daemon, waiting first if the configured call rate is exceeded
+        """
+
+        self.wait(method)
+        return getattr(self.conn, method)(*args)
+
+    def batch(self, calls):
+        """
+        Send calls, a list of (method, params) tuples, to coin daemon in one batch request.
+        Falls back to one request per call if daemon doesn't support batches.
+        Returns a list with result of each call, or CtbRpcException instance for calls that failed.
+        """
+
+        if self.batch_ok:
+            self.wait('batch')
+            try:
+                return self.conn.batch(calls)
+            except CtbRpcException as e:
+                lg.warning("CtbCoin::batch(): %s daemon rejected batch request (%s), falling back to single calls", self.conf.name, e)
+                self.batch_ok = False
+
+        results = []
+        for method, params in calls:
+            try:
+                results.append(self.rpc(method, *params))
+            except CtbRpcException as e:
+                results.append(e)
+        return results
+
+    def waited(self):
+        """
+        Return total number of seconds callers spent waiting for the rate limit
+        """
+
+        return self.limiter.waited if self.limiter else 0.0
+
+    def open_session(self):
+        """
+        Begin wallet session (sessions can be nested, and shared between threads)
+        """
+
+        with self.wallet_lock:
+            self.sessions += 1
+
+    def close_session(self):
+        """
+        End wallet session, locking wallet if it was unlocked and this was the last open session
+        """
+
+        with self.wallet_lock:
+            self.sessions -= 1
+            if self.sessions <= 0:
+                self.sessions = 0
+                self.lock_wallet()
+
+    @contextlib.contextmanager
+    def wallet_session(self):
+        """
+        Keep wallet unlocked (once it's needed) until the end of the with block, then lock it, also on error
+        """
+
+        self.open_session()
+        try:
+            yield self
+        finally:
+            self.close_session()
+
+    def unlock_wallet(self):
+        """
+        Unlock wallet, if applicable and not already unlocked for a while yet. Must be called inside a wallet session.
+        """
+
+        if not hasattr(self.conf, 'walletpassphrase'):
+            return
+
+        with self.wallet_lock:
+            if time.time() + WALLET_UNLOCK_MARGIN < self.unlocked_until:
+                return
+            # Older daemons refuse to unlock a wallet that is still unlocked, so lock it first
+            if self.unlocked_until:
+                lg.debug("CtbCoin::unlock_wallet(): unlock window of %s wallet is ending, locking it first...", self.conf.name)
+                self.rpc('walletlock')
+                self.unlocked_until = 0
+
+            lg.debug("CtbCoin::unlock_wallet(): unlocking %s wallet for %ss...", self.conf.name, self.wallet_unlock_seconds)
+            try:
+                self.rpc('walletpassphrase', self.conf.walletpassphrase, self.wallet_unlock_seconds)
+            except CtbRpcException as e:
+                if e.code != WALLET_ALREADY_UNLOCKED:
+                    raise
+                # Unlocked by someone else, for an unknown time: lock and unlock again for a known window
+                lg.warning("CtbCoin::unlock_wallet(): %s wallet was already unlocked, unlocking it again", self.conf.name)
+                self.rpc('walletlock')
+                self.rpc('walletpassphrase', self.conf.walletpassphrase, self.wallet_unlock_seconds)
+            self.unlocked_until = time.time() + self.wallet_unlock_seconds
+
+    def lock_wallet(self):
+        """
+        Lock wallet if it's unlocked. Errors are logged, not raised (daemon locks wallet itself when unlock window ends).
+        """
+
+        with self.wallet_lock:
+            if not self.unlocked_until:
+                return
+            self.unlocked_until = 0
+            try:
+                lg.debug("CtbCoin::lock_wallet(): locking %s wallet...", self.conf.name)
+                self.rpc('walletlock')
+            except Exception as e:
+                lg.error("CtbCoin::lock_wallet(): error locking %s wallet: %s", self.conf.name, e)
 
-    def getbalance(self, _user = None, _minconf = None):
+    def getbalance(self, _user = None, _minconf = None, _strict = False):
         """
         Get user's tip or withdraw balance. _minconf is number of confirmations to use.
+        Balance is served from cache if it was fetched less than balance_ttl seconds ago, unless _strict is True.
         Returns (float) balance
         """
         lg.debug("CtbCoin::getbalance(%s, %s)", _user, _minconf)
@@ -66,14 +246,87 @@ class CtbCoin(object):
         minconf = self.verify_minconf(_minconf=_minconf)
         balance = float(0)
 
+        if not _strict:
+            balance = self.cached_balance(user, minconf)
+            if balance is not None:
+                return balance
+
         try:
-            balance = self.conn.getbalance(user, minconf)
-        except BitcoindException as e:
+            balance = float(self.rpc('getbalance', user, minconf))
+        except CtbRpcException as e:
             lg.error("CtbCoin.getbalance(): error getting %s (minconf=%s) balance for %s: %s", self.conf.name, minconf, user, e)
             raise
 
-        time.sleep(0.5)
-        return float(balance)
+        self.cache_balance(user, minconf, balance)
+        return balance
+
+    def cached_balance(self, user, minconf):
+        """
+        Return cached balance of user, or None if it's not cached or expired
+        """
+
+        with self.balance_lock:
+            cached = self.balances.get((user, minconf))
+            if cached and time.time() - cached[1] < self.balance_ttl:
+                self.counters['balance_hits'] += 1
+                return cached[0]
+            self.counters['balance_misses'] += 1
+            return None
+
+    def cache_balance(self, user, minconf, balance):
+        """
+        Store balance of user in cache
+        """
+
+        with self.balance_lock:
+            self.balances[(user, minconf)] = (balance, time.time())
+
+    def invalidate_balance(self, *users):
+        """
+        Remove cached balances of users (all minconf values)
+        """
+
+        users = set(str(u).lower() for u in users if u)
+        with self.balance_lock:
+            for key in [k for k in self.balances if k[0] in users]:
+                del self.balances[key]
+
+    def getbalances(self, _users = None, _minconf = None, _strict = False, _wallet = False):
+        """
+        Get tip or withdraw balances of a list of users, in as few requests as possible. _minconf is number of confirmations to use.
+        Balances are served from cache like getbalance(), unless _strict is True.
+        If _wallet is True, total wallet balance is fetched in the same request and returned under key None.
+        Returns dictionary of (float) balance by (lowercase) username
+        """
+        lg.debug("CtbCoin::getbalances(%s users, %s)", len(_users or []), _minconf)
+
+        users = [self.verify_user(_user=u) for u in _users or []]
+        minconf = self.verify_minconf(_minconf=_minconf)
+        balances = {}
+
+        if not _strict:
+            for user in users:
+                balance = self.cached_balance(user, minconf)
+                if balance is not None:
+                    balances[user] = balance
+            users = [u for u in users if u not in balances]
+
+        calls = [(u, ('getbalance', [u, minconf])) for u in users]
+        if _wallet:
+            calls.insert(0, (None, ('getbalance', [])))
+
+        for i in range(0, len(calls), RPC_BATCH_SIZE):
+            chunk = calls[i:i + RPC_BATCH_SIZE]
+            results = self.batch([call for user, call in chunk])
+            for (user, call), balance in zip(chunk, results):
+                if isinstance(balance, CtbRpcException):
+                    lg.error("CtbCoin.getbalances(): error getting %s (minconf=%s) balance for %s: %s", self.conf.name, minconf, user or 'wallet', balance)
+                    raise balance
+                balances[user] = float(balance)
+                if user:
+                    self.cache_balance(user, minconf, balances[user])
+
+        return balances
 
     def sendtouser(self, _userfrom = None, _userto = None, _amount = None, _minconf = 1):
         """
@@ -89,13 +342,13 @@ class CtbCoin(object):
         # send request to coin daemon
         try:
             lg.info("CtbCoin::sendtouser(): moving %.9f %s from %s to %s", amount, self.conf.name, userfrom, userto)
-            result = self.conn.move(userfrom, userto, amount)
-            time.sleep(0.5)
+            result = self.rpc('move', userfrom, userto, amount)
         except Exception as e:
             lg.error("CtbCoin::sendtouser(): error moving %.9f %s from %s to %s: %s", amount, self.conf.name, userfrom, userto, e)
             return False
+        finally:
+            self.invalidate_balance(userfrom, userto)
 
-        time.sleep(0.5)
         return True
 
     def sendtoaddr(self, _userfrom = None, _addrto = None, _amount = None):
@@ -115,25 +368,21 @@ class CtbCoin(object):
         try:
             lg.info("CtbCoin::sendtoaddr(): sending %.9f %s from %s to %s", amount, self.conf.name, userfrom, addrto)
 
-            # Unlock wallet, if applicable
-            if hasattr(self.conf, 'walletpassphrase'):
-                lg.debug("CtbCoin::sendtoaddr(): unlocking wallet...")
-                self.conn.walletpassphrase(self.conf.walletpassphrase, 1)
-
-            # Perform transaction
-            lg.debug("CtbCoin::sendtoaddr(): calling sendfrom()...")
-            txid = self.conn.sendfrom(userfrom, addrto, amount, minconf)
+            # Unlock wallet, if applicable (it's locked at the end of the outermost wallet session)
+            with self.wallet_session():
+                self.unlock_wallet()
 
-            # Lock wallet, if applicable
-            if hasattr(self.conf, 'walletpassphrase'):
-                lg.debug("CtbCoin::sendtoaddr(): locking wallet...")
-                self.conn.walletlock()
+                # Perform transaction
+                lg.debug("CtbCoin::sendtoaddr(): calling sendfrom()...")
+                txid = self.rpc('sendfrom', userfrom, addrto, amount, minconf)
 
         except Exception as e:
             lg.error("CtbCoin::sendtoaddr(): error sending %.9f %s from %s to %s: %s", amount, self.conf.name, userfrom, addrto, e)
             raise
+        finally:
+            # Recipient's account (if address belongs to this wallet) is picked up when its cached balance expires
+            self.invalidate_balance(userfrom)
 
-        time.sleep(0.5)
         return str(txid)
 
     def validateaddr(self, _addr = None):
@@ -144,8 +393,7 @@ class CtbCoin(object):
         lg.debug("CtbCoin::validateaddr(%s)", _addr)
 
         addr = self.verify_addr(_addr=_addr)
-        addr_valid = self.conn.validateaddress(addr)
-        time.sleep(0.5)
+        addr_valid = self.rpc('validateaddress', addr)
 
         if not addr_valid.has_key('isvalid') or not addr_valid['isvalid']:
             lg.debug("CtbCoin::validateaddr(%s): not valid", addr)
@@ -162,48 +410,74 @@ class CtbCoin(object):
 
         user = self.verify_user(_user=_user)
         addr = ""
-        counter = 0
 
-        while True:
-            try:
-                # Unlock wallet for keypoolrefill
-                if hasattr(self.conf, 'walletpassphrase'):
-                    self.conn.walletpassphrase(self.conf.walletpassphrase, 1)
+        # Connection failures before the request is sent are retried by CtbRpc
+        try:
+            # Unlock wallet for keypoolrefill
+            with self.wallet_session():
+                self.unlock_wallet()
 
                 # Generate new address
-                addr = self.conn.getnewaddress(user)
+                addr = self.rpc('getnewaddress', user)
+
+            if not addr:
+                raise Exception("CtbCoin::getnewaddr(%s): empty addr", user)
+
+            return str(addr)
+
+        except CtbRpcException as e:
+            lg.error("CtbCoin::getnewaddr(%s): CtbRpcException: %s", user, e)
+            raise
+        except Exception as e:
+            lg.error("CtbCoin::getnewaddr(%s): Exception: %s", user, e)
+            raise
 
-                # Lock wallet
-                if hasattr(self.conf, 'walletpassphrase'):
-                    self.conn.walletlock()
+    def getnewaddrs(self, _user = None, _count = None):
+        """
+        Generate _count new addresses for _user, unlocking wallet only once
+        Returns (list) of addresses
+        """
+        lg.debug("CtbCoin::getnewaddrs(%s, %s)", _user, _count)
 
-                if not addr:
-                    raise Exception("CtbCoin::getnewaddr(%s): empty addr", user)
+        user = self.verify_user(_user=_user)
+        addrs = []
 
-                time.sleep(0.1)
-                return str(addr)
+        try:
+            with self.wallet_session():
+                while len(addrs) < _count:
+                    # Unlock wallet for keypoolrefill (again, if unlock window is about to end)
+                    self.unlock_wallet()
 
-            except BitcoindException as e:
-                lg.error("CtbCoin::getnewaddr(%s): BitcoindException: %s", user, e)
+                    results = self.batch([('getnewaddress', [user])] * min(RPC_BATCH_SIZE, _count - len(addrs)))
+                    errors = [r for r in results if isinstance(r, CtbRpcException)]
+                    addrs.extend([str(r) for r in results if r and not isinstance(r, CtbRpcException)])
+                    if errors:
+                        raise errors[0]
+
+        except Exception as e:
+            lg.error("CtbCoin::getnewaddrs(%s): got %s of %s addresses: %s", user, len(addrs), _count, e)
+            if not addrs:
                 raise
-            except CannotSendRequest as e:
-                if counter < 3:
-                    lg.warning("CtbCoin::getnewaddr(%s): CannotSendRequest, retrying")
-                    counter += 1
-                    time.sleep(10)
-                    continue
-                else:
-                    raise
-            except Exception as e:
-                if str(e) == "timed out" and counter < 3:
-                    lg.warning("CtbCoin::getnewaddr(%s): timed out, retrying")
-                    counter += 1
-                    time.sleep(10)
-                    continue
-                else:
-                    lg.error("CtbCoin::getnewaddr(%s): Exception: %s", user, e)
-                    raise
 
+        return addrs
+
+    def setaccount(self, _addr = None, _user = None):
+        """
+        Assign existing wallet address _addr to _user
+        Returns (string) address
+        """
+        lg.debug("CtbCoin::setaccount(%s, %s)", _addr, _user)
+
+        addr = self.verify_addr(_addr=_addr)
+        user = self.verify_user(_user=_user)
+
+        try:
+            self.rpc('setaccount', addr, user)
+        except CtbRpcException as e:
+            lg.error("CtbCoin::setaccount(%s, %s): CtbRpcException: %s", addr, user, e)
+            raise
+
+        return addr
 
     def verify_user(self, _user = None):
         """
@@ -16,18 +16,206 @@
 """
 
 from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, Numeric, UnicodeText
-from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.pool import QueuePool, SingletonThreadPool
+
+import contextlib, logging, re, threading, time
+
+lg = logging.getLogger('cointipbot')
+
+def add_index(conn, table, name, columns):
+  '''Add index on columns to table, unless an index with this name already exists'''
+  sql = "SELECT 1 FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s LIMIT 1"
+  if conn.execute(sql, (table, name)).rowcount > 0:
+    lg.debug("add_index(): index %s on %s already exists", name, table)
+    return False
+  conn.execute("ALTER TABLE `%s` ADD INDEX `%s` (%s)" % (table, name, ", ".join(["`%s`" % c for c in columns])))
+  return True
+
+def user_totals_select():
+  '''Return query aggregating completed tips in t_action into t_user_totals rows'''
+  parts = []
+  for direction, user_col in [('tipped', 'from_user'), ('received', 'to_user')]:
+    for kind, val_col in [('coin', 'coin_val'), ('fiat', 'fiat_val')]:
+      parts.append("SELECT %s AS username, '%s' AS direction, '%s' AS kind, %s AS unit, SUM(%s) AS total, COUNT(*) AS count "
+                   "FROM t_action WHERE type = 'givetip' AND state = 'completed' AND %s IS NOT NULL AND %s IS NOT NULL AND %s IS NOT NULL "
+                   "GROUP BY %s, %s" % (user_col, direction, kind, kind, val_col, user_col, kind, val_col, user_col, kind))
+  return " UNION ALL ".join(parts)
+
+def rebuild_user_totals(conn):
+  '''Recompute t_user_totals from t_action, return number of rows inserted'''
+  conn.execute("DELETE FROM t_user_totals")
+  return conn.execute("INSERT INTO t_user_totals (username, direction, kind, unit, total, count) " + user_totals_select()).rowcount
+
+def create_user_totals(conn):
+  '''Create and fill t_user_totals'''
+  conn.execute("CREATE TABLE IF NOT EXISTS `t_user_totals` ("
+               "`username` varchar(30) NOT NULL, "
+               "`direction` enum('tipped','received') NOT NULL, "
+               "`kind` enum('coin','fiat') NOT NULL, "
+               "`unit` varchar(3) NOT NULL, "
+               "`total` double NOT NULL DEFAULT '0', "
+               "`count` int(11) NOT NULL DEFAULT '0', "
+               "PRIMARY KEY (`username`,`direction`,`kind`,`unit`)"
+               ") ENGINE=InnoDB DEFAULT CHARSET=utf8")
+  rebuild_user_totals(conn)
+
+def create_action_summary(conn):
+  '''Create t_action_summary, empty, with its watermark at 0'''
+  conn.execute("CREATE TABLE IF NOT EXISTS `t_action_summary` ("
+               "`type` varchar(10) NOT NULL, "
+               "`state` varchar(10) NOT NULL, "
+               "`coin` varchar(3) NOT NULL DEFAULT '', "
+               "`fiat` varchar(3) NOT NULL DEFAULT '', "
+               "`from_user` varchar(30) NOT NULL, "
+               "`to_user` varchar(30) NOT NULL DEFAULT '', "
+               "`total_coin` double DEFAULT NULL, "
+               "`total_fiat` double DEFAULT NULL, "
+               "`count` int(11) NOT NULL DEFAULT '0', "
+               "PRIMARY KEY (`type`,`state`,`coin`,`fiat`,`from_user`,`to_user`)"
+               ") ENGINE=InnoDB DEFAULT CHARSET=utf8")
+  conn.execute("INSERT IGNORE INTO t_values (param0, value0) VALUES ('summary_watermark', 0)")
+
+def create_addr_pool(conn):
+  '''Create t_addr_pool of pre-generated addresses not yet assigned to a user'''
+  conn.execute("CREATE TABLE IF NOT EXISTS `t_addr_pool` ("
+               "`id` int(11) unsigned NOT NULL AUTO_INCREMENT, "
+               "`coin` varchar(3) NOT NULL, "
+               "`address` varchar(34) NOT NULL, "
+               "`created_utc` int(11) unsigned NOT NULL, "
+               "PRIMARY KEY (`id`), "
+               "UNIQUE KEY `address` (`address`), "
+               "KEY `idx_coin_id` (`coin`,`id`)"
+               ") ENGINE=InnoDB DEFAULT CHARSET=utf8")
+
+def add_action_id(conn):
+  '''Add insertion-ordered id to t_action, and reset t_action_summary, whose watermark is an id from now on'''
+  sql = "SELECT 1 FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = 't_action' AND column_name = 'id' LIMIT 1"
+  if conn.execute(sql).rowcount <= 0:
+    conn.execute("ALTER TABLE `t_action` ADD COLUMN `id` int(11) unsigned NOT NULL AUTO_INCREMENT, ADD UNIQUE KEY `id` (`id`)")
+  conn.execute("DELETE FROM t_action_summary")
+  conn.execute("REPLACE INTO t_values (param0, value0) VALUES ('summary_watermark', 0), ('summary_candidate', 0)")
+
+# Numbered schema migrations, applied in order and recorded in t_schema_version.
+# Each migration must be safe to run against a database that already has the change.
+MIGRATIONS = [
+  (1, "t_action index for accept/decline lookups",
+    lambda conn: add_index(conn, 't_action', 'idx_to_user_state_type', ['to_user', 'state', 'type'])),
+  (2, "t_action index for expire_pending_tips",
+    lambda conn: add_index(conn, 't_action', 'idx_state_created_utc', ['state', 'created_utc'])),
+  (3, "t_action index for redeem checks and user stats",
+    lambda conn: add_index(conn, 't_action', 'idx_from_user_type_state_coin', ['from_user', 'type', 'state', 'coin'])),
+  (4, "t_action index for self-checks",
+    lambda conn: add_index(conn, 't_action', 'idx_type_state_coin', ['type', 'state', 'coin'])),
+  (5, "t_user_totals per-user tip totals", create_user_totals),
+  (6, "t_action_summary for global stats", create_action_summary),
+  (7, "t_addr_pool of pre-generated addresses", create_addr_pool),
+  (8, "t_action insertion-ordered id for t_action_summary watermark", add_action_id),
+]
+
+def migrate(engine, migrations=MIGRATIONS):
+  '''Apply migrations not yet recorded in t_schema_version, return list of applied versions'''
+  applied = []
+  conn = engine.connect()
+  try:
+    # Serialize concurrent runners (bot and helper scripts starting at the same time)
+    conn.execute("SELECT GET_LOCK('ctb_migrate', 60)")
+    conn.execute("CREATE TABLE IF NOT EXISTS `t_schema_version` ("
+                 "`version` int(11) unsigned NOT NULL, "
+                 "`description` varchar(200) NOT NULL, "
+                 "`applied_utc` int(11) unsigned NOT NULL, "
+                 "PRIMARY KEY (`version`)"
+                 ") ENGINE=InnoDB DEFAULT CHARSET=utf8")
+    done = set([m['version'] for m in conn.execute("SELECT version FROM t_schema_version")])
+
+    for version, description, apply in sorted(migrations):
+      if version in done:
+        continue
+      lg.info("migrate(): applying migration %s (%s)", version, description)
+      apply(conn)
+      conn.execute("INSERT INTO t_schema_version (version, description, applied_utc) VALUES (%s, %s, %s)", (version, description, int(time.time())))
+      applied.append(version)
+
+  finally:
+    conn.execute("SELECT RELEASE_LOCK('ctb_migrate')")
+    conn.close()
+
+  return applied
+
+def explain(conn, sql):
+  '''Return EXPLAIN output rows (as dicts) for a SELECT query with %s placeholders'''
+  sql = re.sub(r'(?i)LIMIT\s+%s', 'LIMIT 1', sql)
+  params = tuple([''] * sql.count('%s'))
+  return [dict(r) for r in conn.execute("EXPLAIN " + sql, params)]
+
+def check_indexes(conn, queries, table='t_action'):
+  '''Return list of (name, explain row) for queries that scan the whole table'''
+  result = []
+  for name, sql in queries:
+    if not sql.strip().upper().startswith('SELECT'):
+      continue
+    for r in explain(conn, sql):
+      if r['table'] == table and r['type'] == 'ALL':
+        result.append((name, r))
+  return result
+
+class CointipBotConnection(object):
+  '''
+  Wrapper around an engine. Statements run in the calling thread's unit of
+  work if one is open, otherwise they are autocommitted as before.
+  '''
+
+  def __init__(self, engine):
+    self.engine = engine
+    self.local = threading.local()
+
+  def __getattr__(self, name):
+    return getattr(self.engine, name)
+
+  def execute(self, *args, **kwargs):
+    conn = getattr(self.local, 'conn', None)
+    if conn is not None:
+      return conn.execute(*args, **kwargs)
+    return self.engine.execute(*args, **kwargs)
+
+  @contextlib.contextmanager
+  def unit_of_work(self):
+    '''Run enclosed statements in one transaction (nested units join the outer one)'''
+    if getattr(self.local, 'conn', None) is not None:
+      yield self
+      return
+
+    conn = self.engine.connect()
+    trans = conn.begin()
+    self.local.conn = conn
+    try:
+      yield self
+    finally:
+      self.local.conn = None
+      try:
+        # Commit even if the action failed halfway: coins may have been moved
+        # already, and rolling back t_action would let the same message be replayed
+        trans.commit()
+      finally:
+        conn.close()
 
 class CointipBotDatabase:
 
   metadata = MetaData()
 
-  def __init__(self, dsn_url):
-    '''Pass a DSN URL conforming to the SQLAlchemy API'''
+  def __init__(self, dsn_url, pool=None):
+    '''Pass a DSN URL conforming to the SQLAlchemy API, and optional pool config'''
     self.dsn_url = dsn_url
+    self.pool = pool
 
   def connect(self):
     '''Return a connection object'''
-    engine = create_engine(self.dsn_url, echo_pool=True, poolclass=SingletonThreadPool)
+    if self.pool:
+      kwargs = {'poolclass': QueuePool, 'pool_size': self.pool.size, 'max_overflow': self.pool.max_overflow, 'pool_recycle': self.pool.recycle}
+      if hasattr(self.pool, 'pre_ping') and self.pool.pre_ping:
+        kwargs['pool_pre_ping'] = True
+      engine = create_engine(self.dsn_url, **kwargs)
+    else:
+      engine = create_engine(self.dsn_url, echo_pool=True, poolclass=SingletonThreadPool)
     self.metadata.create_all(engine)
-    return engine
+    migrate(engine)
+    return CointipBotConnection(engine)
@@ -17,7 +17,9 @@
 
 import ctb_user
 
-import logging, time
+import logging, threading, time
+from multiprocessing.pool import ThreadPool
+from multiprocessing import TimeoutError
 
 from requests.exceptions import HTTPError, ConnectionError, Timeout
 from praw.exceptions import APIException, ClientException
@@ -26,6 +28,79 @@ from socket import timeout
 lg = logging.getLogger('cointipbot')
 
 
+class TokenBucket(object):
+    """
+    Thread-safe rate limiter: lets through bursts of up to `burst` calls,
+    and `rate` calls per second on average
+    """
+
+    def __init__(self, rate=1.0, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until it is available. Return number of seconds waited.
+        """
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve a token even if it's not there yet, so that waiting callers queue up
+            self.tokens -= 1.0
+            wait = -self.tokens / self.rate if self.tokens < 0.0 else 0.0
+            self.waited += wait
+
+        if wait > 0.0:
+            time.sleep(wait)
+        return wait
+
+def fan_out(func, keys, timeout=None):
+    """
+    Call func(key) for each key concurrently, one thread per key.
+    timeout is number of seconds (or dictionary of seconds by key) to wait for each result.
+    Returns (results, errors) dictionaries by key; a call that timed out has TimeoutError in errors.
+    """
+
+    keys = list(keys)
+    results, errors = {}, {}
+    if not keys:
+        return (results, errors)
+
+    pool = ThreadPool(len(keys))
+    try:
+        start = time.time()
+        pending = [(k, pool.apply_async(func, (k,))) for k in keys]
+        pool.close()
+
+        for k, r in pending:
+            t = timeout.get(k) if isinstance(timeout, dict) else timeout
+            try:
+                results[k] = r.get(None if t is None else max(0.0, start + t - time.time()))
+            except TimeoutError:
+                errors[k] = TimeoutError("fan_out(): %s timed out after %ss" % (k, t))
+            except Exception as e:
+                errors[k] = e
+
+    finally:
+        # Stop the pool's handler threads. Threads can't be killed, so a worker stuck in a call
+        # exits as soon as the call returns (coin daemon calls are bounded by the socket timeout,
+        # and release their database connection on the way out).
+        pool.terminate()
+        if not any(isinstance(e, TimeoutError) for e in errors.values()):
+            pool.join()
+
+    return (results, errors)
+
+# Rate limiter for praw_call() in the current thread, in reddit_limiter.bucket
+# (set by update_all_user_stats() for its workers; other callers are not limited)
+reddit_limiter = threading.local()
+
 def praw_call(prawFunc, *extraArgs, **extraKwArgs):
     """
     Call prawFunc() with extraArgs and extraKwArgs
@@ -34,6 +109,10 @@ def praw_call(prawFunc, *extraArgs, **extraKwArgs):
 
     while True:
 
+        limiter = getattr(reddit_limiter, 'bucket', None)
+        if limiter:
+            limiter.acquire()
+
         try:
             res = prawFunc(*extraArgs, **extraKwArgs)
             return res
@@ -151,14 +230,13 @@ def add_coin(coin, db, coins):
 
         mysqlsel = db.execute(sql_select, (coin))
         for m in mysqlsel:
-            # Generate new coin address for user
-            new_addr = coins[coin].getnewaddr(_user=m['username'])
+            # Take new coin address for user from pool
+            new_addr = claim_addr(coin, m['username'], db, coins)
             lg.info("add_coin(): got new address %s for %s", new_addr, m['username'])
             # Add new coin address to MySQL
             mysqlins = db.execute(sql_insert, (m['username'].lower(), coin, new_addr))
             if mysqlins.rowcount <= 0:
                 raise Exception("add_coin(%s): rowcount <= 0 when executing <%s>", coin, sql_insert % (m['username'].lower(), coin, new_addr))
-            time.sleep(1)
 
     except Exception, e:
         lg.error("add_coin(%s): error: %s", coin, e)
@@ -167,6 +245,59 @@ def add_coin(coin, db, coins):
     lg.debug("< add_coin(%s) DONE", coin)
     return True
 
+# Wallet account holding pool addresses until they are claimed (':' can't appear in Reddit usernames)
+ADDR_POOL_ACCOUNT = 'ctb:addrpool'
+
+def claim_addr(coin, username, db, coins):
+    """
+    Assign an address from t_addr_pool to username, or generate a new one if pool is empty
+    Returns (string) address
+    """
+    lg.debug("> claim_addr(%s, %s)", coin, username)
+
+    with db.unit_of_work():
+        mysqlrow = db.execute("SELECT id, address FROM t_addr_pool WHERE coin = %s ORDER BY id LIMIT 1 FOR UPDATE", (coin)).fetchone()
+        if mysqlrow:
+            # Remove address from pool even if it can't be assigned, so it isn't tried again
+            db.execute("DELETE FROM t_addr_pool WHERE id = %s", (mysqlrow['id']))
+            try:
+                addr = coins[coin].setaccount(_addr=mysqlrow['address'], _user=username.lower())
+                lg.debug("< claim_addr(%s, %s) DONE (pool)", coin, username)
+                return addr
+            except Exception as e:
+                lg.warning("claim_addr(%s, %s): can't assign pool address %s: %s", coin, username, mysqlrow['address'], e)
+        else:
+            lg.warning("claim_addr(%s, %s): address pool is empty", coin, username)
+
+    addr = coins[coin].getnewaddr(_user=username.lower())
+    lg.debug("< claim_addr(%s, %s) DONE (new)", coin, username)
+    return addr
+
+def refill_addr_pool(coin, db, coins, size):
+    """
+    Generate new addresses until t_addr_pool has size unclaimed addresses of coin
+    Returns (int) number of addresses added
+    """
+    lg.debug("> refill_addr_pool(%s, %s)", coin, size)
+
+    mysqlrow = db.execute("SELECT COUNT(*) AS count FROM t_addr_pool WHERE coin = %s", (coin)).fetchone()
+    need = size - int(mysqlrow['count'])
+    if need <= 0:
+        lg.debug("< refill_addr_pool(%s, %s) DONE (full)", coin, size)
+        return 0
+
+    # Wallet is unlocked once for the whole refill, and locked again at the end
+    with coins[coin].wallet_session():
+        addrs = coins[coin].getnewaddrs(_user=ADDR_POOL_ACCOUNT, _count=need)
+    now = int(time.time())
+    with db.unit_of_work():
+        for addr in addrs:
+            db.execute("INSERT INTO t_addr_pool (coin, address, created_utc) VALUES (%s, %s, %s)", (coin, addr, now))
+
+    lg.info("refill_addr_pool(%s): added %s addresses", coin, len(addrs))
+    lg.debug("< refill_addr_pool(%s, %s) DONE", coin, size)
+    return len(addrs)
+
 class DotDict(object):
     def __init__(self, d):
         for a, b in d.items():
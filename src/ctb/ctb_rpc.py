@@ -0,0 +1,221 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import base64, decimal, httplib, itertools, json, logging, os, select, socket, threading, time
+
+lg = logging.getLogger('cointipbot')
+
+# Methods that are safe to repeat if the connection fails after the request was sent
+IDEMPOTENT_METHODS = set(['getbalance', 'getinfo', 'getaccount', 'getaccountaddress', 'getaddressesbyaccount',
+                          'validateaddress', 'settxfee', 'setaccount', 'walletlock', 'walletpassphrase', 'backupwallet'])
+
+class CtbRpcException(Exception):
+    """
+    Error returned by coin daemon
+    """
+
+    def __init__(self, error):
+        self.error = error
+        self.code = error.get('code') if isinstance(error, dict) else None
+        self.message = error.get('message') if isinstance(error, dict) else str(error)
+        Exception.__init__(self, "%s (code %s)" % (self.message, self.code))
+
+class CtbRpcRetry(Exception):
+    """
+    Connection failed in a way that allows the request to be retried
+    """
+    pass
+
+def read_config(config_file):
+    """
+    Read key=value pairs from coin daemon config file
+    """
+
+    conf = {}
+    for line in open(os.path.expanduser(config_file)):
+        line = line.strip()
+        if not line or line.startswith('#') or not '=' in line:
+            continue
+        k, v = line.split('=', 1)
+        conf[k.strip()] = v.strip()
+
+    return conf
+
+class CtbRpc(object):
+    """
+    JSON-RPC client for a coin daemon, keeping a pool of keep-alive HTTP connections.
+    Daemon methods can be called as attributes, e.g. rpc.getbalance(user, minconf).
+    """
+
+    def __init__(self, config_file, rpcserver='127.0.0.1', rpcport=None, pool_size=2, timeout=30, retries=3, backoff=0.1, backoff_max=5.0, max_idle=60):
+        conf = read_config(config_file)
+        if not conf.has_key('rpcuser') or not conf.has_key('rpcpassword'):
+            raise Exception("CtbRpc::__init__(): rpcuser or rpcpassword missing from %s" % config_file)
+
+        self.host = rpcserver
+        self.port = int(rpcport or conf.get('rpcport', 8332))
+        self.auth = 'Basic ' + base64.b64encode('%s:%s' % (conf['rpcuser'], conf['rpcpassword']))
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.max_idle = max_idle
+
+        self.idle = []
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *params: self.call(method, *params)
+
+    def acquire(self):
+        """
+        Return an idle healthy connection from pool, or a new one
+        """
+
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, since = self.idle.pop()
+
+            if time.time() - since < self.max_idle and self.healthy(conn):
+                return conn
+            conn.close()
+
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def release(self, conn):
+        """
+        Return connection to pool (or close it if pool is full)
+        """
+
+        with self.lock:
+            if len(self.idle) < self.pool_size:
+                self.idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def healthy(self, conn):
+        """
+        Return False if idle connection was closed by daemon (socket readable at EOF)
+        """
+
+        if not conn.sock:
+            return False
+        try:
+            readable, w, x = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def post(self, payload, retry):
+        """
+        Send payload (list or dict) to daemon and return decoded response.
+        Failures before the request is sent raise CtbRpcRetry; after it is sent, only if retry is True.
+        """
+
+        conn = self.acquire()
+        body = json.dumps(payload)
+        try:
+            conn.request('POST', '/', body, {'Authorization': self.auth, 'Content-Type': 'application/json'})
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            raise CtbRpcRetry(e)
+
+        try:
+            response = conn.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            if retry:
+                raise CtbRpcRetry(e)
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+
+        if response.status == 401:
+            raise Exception("CtbRpc::post(): authorization failed")
+        try:
+            return json.loads(data, parse_float=decimal.Decimal)
+        except ValueError:
+            raise Exception("CtbRpc::post(): invalid response (HTTP %s): %s" % (response.status, data[:200]))
+
+    def send(self, payload, retry):
+        """
+        Post payload, reconnecting with bounded exponential backoff when allowed
+        """
+
+        attempt = 0
+        while True:
+            try:
+                return self.post(payload, retry)
+            except CtbRpcRetry as e:
+                if attempt >= self.retries:
+                    raise e.args[0]
+                delay = min(self.backoff * (2 ** attempt), self.backoff_max)
+                lg.warning("CtbRpc::send(): connection to %s:%s failed (%s), retrying in %.1fs", self.host, self.port, e.args[0], delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def call(self, method, *params):
+        """
+        Call method with params on daemon and return its result
+        """
+
+        response = self.send({'jsonrpc': '1.0', 'id': next(self.ids), 'method': method, 'params': list(params)}, method in IDEMPOTENT_METHODS)
+        if response.get('error'):
+            raise CtbRpcException(response['error'])
+        return response['result']
+
+    def batch(self, calls):
+        """
+        Send calls, a list of (method, params) tuples, as one JSON-RPC 2.0 batch request.
+        Returns a list with result of each call, in order, or CtbRpcException instance for calls that failed.
+        Raises CtbRpcException if daemon rejected the batch as a whole.
+        """
+
+        if not calls:
+            return []
+
+        ids = [next(self.ids) for c in calls]
+        payload = [{'jsonrpc': '2.0', 'id': i, 'method': m, 'params': list(p)} for i, (m, p) in zip(ids, calls)]
+        response = self.send(payload, all(m in IDEMPOTENT_METHODS for m, p in calls))
+
+        if not isinstance(response, list):
+            # Daemons without batch support answer with a single error object
+            raise CtbRpcException(response.get('error') if isinstance(response, dict) and response.get('error') else "batch request not supported")
+
+        # Responses may come back in any order; match them to calls by id
+        byid = dict((r.get('id'), r) for r in response if isinstance(r, dict))
+        results = []
+        for i, (m, p) in zip(ids, calls):
+            r = byid.get(i)
+            if r is None:
+                results.append(CtbRpcException("no response to %s (id %s)" % (m, i)))
+            elif r.get('error'):
+                results.append(CtbRpcException(r['error']))
+            else:
+                results.append(r['result'])
+
+        return results
@@ -18,12 +18,81 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import logging, re, time
-import ctb_misc
+import copy, hashlib, logging, os, Queue, re, threading, time
+import ctb_db, ctb_misc
 
 lg = logging.getLogger('cointipbot')
 
-def update_stats(ctb=None):
+# Maximum number of users per flair update request accepted by Reddit
+FLAIR_BATCH_SIZE = 100
+
+class CtbFakeFlair(object):
+    """
+    Stand-in for subreddit flair, used when conf.reddit.stats.fake_flair is set.
+    Records flair updates instead of submitting them to Reddit.
+    """
+
+    def __init__(self):
+        self.updates = []
+
+    def update(self, flair_list):
+        lg.info("CtbFakeFlair::update(): %s users", len(flair_list))
+        self.updates.append(list(flair_list))
+        return [{'ok': True, 'status': 'fake'} for f in flair_list]
+
+def refresh_summary(ctb=None, rebuild=False):
+    """
+    Fold t_action rows with id above the summary watermark into t_action_summary,
+    and return the new watermark. With rebuild=True, the summary is recomputed from scratch.
+    Only rows that can't change anymore are folded in: below the id of any tip still pending,
+    and already present at the previous refresh (so that rows with lower ids, inserted by
+    transactions that hadn't committed yet, aren't skipped).
+    """
+    lg.debug("> refresh_summary(%s)", rebuild)
+
+    sql = "INSERT INTO t_action_summary (type, state, coin, fiat, from_user, to_user, total_coin, total_fiat, count)"
+    sql += " SELECT type, state, COALESCE(coin, ''), COALESCE(fiat, ''), from_user, COALESCE(to_user, ''), SUM(coin_val), SUM(fiat_val), COUNT(*)"
+    sql += " FROM t_action WHERE id > %s AND id <= %s"
+    sql += " GROUP BY type, state, COALESCE(coin, ''), COALESCE(fiat, ''), from_user, COALESCE(to_user, '')"
+    sql += " ON DUPLICATE KEY UPDATE total_coin = COALESCE(total_coin + VALUES(total_coin), total_coin, VALUES(total_coin)),"
+    sql += " total_fiat = COALESCE(total_fiat + VALUES(total_fiat), total_fiat, VALUES(total_fiat)), count = count + VALUES(count)"
+
+    with ctb.db.unit_of_work():
+        watermark = ctb_misc.get_value(conn=ctb.db, param0='summary_watermark') or 0
+        horizon = ctb_misc.get_value(conn=ctb.db, param0='summary_candidate') or 0
+        if rebuild:
+            ctb.db.execute("DELETE FROM t_action_summary")
+            watermark = 0
+
+        oldest_pending = ctb.db.execute("SELECT MIN(id) AS oldest FROM t_action WHERE state = 'pending'").fetchone()['oldest']
+        if oldest_pending != None and oldest_pending - 1 < horizon:
+            horizon = oldest_pending - 1
+
+        if horizon > watermark:
+            lg.debug("refresh_summary(): folding in rows from %s to %s", watermark, horizon)
+            ctb.db.execute(sql, (watermark, horizon))
+            watermark = horizon
+        ctb_misc.set_value(conn=ctb.db, param0='summary_watermark', value0=watermark)
+
+        # Rows present now can be folded in at the next refresh
+        candidate = ctb.db.execute("SELECT MAX(id) AS newest FROM t_action").fetchone()['newest']
+        ctb_misc.set_value(conn=ctb.db, param0='summary_candidate', value0=candidate or 0)
+
+    lg.debug("< refresh_summary() DONE (%s)", watermark)
+    return watermark
+
+def summary_table(watermark):
+    """
+    Return derived table with t_action_summary rows and t_action rows with id above
+    watermark, having columns type, state, coin, fiat, from_user, to_user,
+    total_coin, total_fiat and count
+    """
+
+    sql = "(SELECT type, state, NULLIF(coin, '') AS coin, NULLIF(fiat, '') AS fiat, from_user, NULLIF(to_user, '') AS to_user, total_coin, total_fiat, count FROM t_action_summary"
+    sql += " UNION ALL SELECT type, state, coin, fiat, from_user, to_user, coin_val, fiat_val, 1 FROM t_action WHERE id > %d)" % int(watermark)
+    return sql
+
+def update_stats(ctb=None, rebuild=False):
     """
     Update stats wiki page
     """
@@ -33,31 +102,36 @@ def update_stats(ctb=None):
     if not ctb.conf.reddit.stats.enabled:
         return None
 
+    # Queries having summary_query read from t_action_summary and the rows newer than its watermark
+    summary = None
+    if [s for s in vars(ctb.conf.db.sql.globalstats) if hasattr(ctb.conf.db.sql.globalstats[s], 'summary_query')]:
+        summary = summary_table(refresh_summary(ctb=ctb, rebuild=rebuild))
+
     for s in sorted(vars(ctb.conf.db.sql.globalstats)):
         lg.debug("update_stats(): getting stats for '%s'" % s)
         sql = ctb.conf.db.sql.globalstats[s].query
+        if summary and hasattr(ctb.conf.db.sql.globalstats[s], 'summary_query'):
+            sql = ctb.conf.db.sql.globalstats[s].summary_query.replace('{SUMMARY}', summary)
         stats += "\n\n### %s\n\n" % ctb.conf.db.sql.globalstats[s].name
         stats += "%s\n\n" % ctb.conf.db.sql.globalstats[s].desc
 
         mysqlexec = ctb.db.execute(sql)
         if mysqlexec.rowcount <= 0:
-            lg.warning("update_stats(): query <%s> returned nothing" % ctb.conf.db.sql.globalstats[s].query)
+            lg.warning("update_stats(): query <%s> returned nothing" % sql)
             continue
 
         if ctb.conf.db.sql.globalstats[s].type == "line":
             m = mysqlexec.fetchone()
             k = mysqlexec.keys()[0]
-            value = format_value(m, k, '', ctb)
+            value = format_plan([k], '', ctb)[0](m)
             stats += "%s = **%s**\n" % (k, value)
 
         elif ctb.conf.db.sql.globalstats[s].type == "table":
             stats += ("|".join(mysqlexec.keys())) + "\n"
             stats += ("|".join([":---"] * len(mysqlexec.keys()))) + "\n"
+            plan = format_plan(mysqlexec.keys(), '', ctb)
             for m in mysqlexec:
-                values = []
-                for k in mysqlexec.keys():
-                    values.append(format_value(m, k, '', ctb))
-                stats += ("|".join(values)) + "\n"
+                stats += ("|".join([f(m) for f in plan])) + "\n"
 
         else:
             lg.error("update_stats(): don't know what to do with type '%s'" % ctb.conf.db.sql.globalstats[s].type)
@@ -81,19 +155,20 @@ def update_tips(ctb=None):
         return None
 
     # Start building stats page
-    tip_list = "### All Completed Tips\n\n"
+    if hasattr(ctb.conf.db.sql.tips, 'sql_page'):
+        tip_list = list_tips(ctb=ctb)
+    else:
+        tip_list = "### All Completed Tips\n\n"
 
-    q = ctb.db.execute(ctb.conf.db.sql.tips.sql_set)
-    tips = ctb.db.execute(ctb.conf.db.sql.tips.sql_list, (ctb.conf.db.sql.tips.limit))
-    tip_list += ("|".join(tips.keys())) + "\n"
-    tip_list += ("|".join([":---"] * len(tips.keys()))) + "\n"
+        q = ctb.db.execute(ctb.conf.db.sql.tips.sql_set)
+        tips = ctb.db.execute(ctb.conf.db.sql.tips.sql_list, (ctb.conf.db.sql.tips.limit))
+        tip_list += ("|".join(tips.keys())) + "\n"
+        tip_list += ("|".join([":---"] * len(tips.keys()))) + "\n"
 
-    # Build tips table
-    for t in tips:
-        values = []
-        for k in tips.keys():
-            values.append(format_value(t, k, '', ctb, compact=True))
-        tip_list += ("|".join(values)) + "\n"
+        # Build tips table
+        plan = format_plan(tips.keys(), '', ctb, compact=True)
+        for t in tips:
+            tip_list += ("|".join([f(t) for f in plan])) + "\n"
 
     lg.debug("update_tips(): updating subreddit '%s', page '%s'" % (ctb.conf.reddit.stats.subreddit, ctb.conf.reddit.stats.page_tips))
     
@@ -103,26 +178,102 @@ def update_tips(ctb=None):
     ctb_misc.praw_call(wp.edit, tip_list, "Update by ALTcointip bot")
     return True
 
-def update_all_user_stats(ctb=None):
+def list_tips(ctb=None):
     """
-    Update individual user stats for all uers
+    Return markdown list of completed tips, reading t_action in pages of
+    conf.db.sql.tips.page_size rows keyed by (created_utc, msg_id)
     """
+    lg.debug("> list_tips()")
+
+    lines = ["### All Completed Tips\n\n"]
+    keys = None
+    plan = None
+    num = 0
+    last = (0, '')
+
+    while num < ctb.conf.db.sql.tips.limit:
+        page_size = min(ctb.conf.db.sql.tips.page_size, ctb.conf.db.sql.tips.limit - num)
+        tips = ctb.db.execute(ctb.conf.db.sql.tips.sql_page, (last[0], last[0], last[1], page_size))
+
+        if keys == None:
+            # Columns as in sql_list: num first, msg_id is only used for paging
+            keys = ['num'] + [k for k in tips.keys() if k != 'msg_id']
+            plan = format_plan(keys, '', ctb, compact=True)
+            lines.append(("|".join(keys)) + "\n")
+            lines.append(("|".join([":---"] * len(keys))) + "\n")
+
+        count = 0
+        for t in tips:
+            num += 1
+            count += 1
+            row = dict(t)
+            row['num'] = num
+            lines.append(("|".join([f(row) for f in plan])) + "\n")
+            last = (t['created_utc'], t['msg_id'])
+
+        if count < page_size:
+            break
+
+    lg.debug("< list_tips() DONE (%s tips)", num)
+    return "".join(lines)
+
+def update_user_totals(ctb=None, from_user=None, to_user=None, coin=None, fiat=None, coin_val=None, fiat_val=None, sign=1):
+    """
+    Add (sign=1) or subtract (sign=-1) a completed tip to/from t_user_totals
+    """
+    lg.debug("> update_user_totals(%s, %s, %s)", from_user, to_user, sign)
 
-    if not ctb.conf.reddit.stats.enabled:
-        lg.error('update_all_user_stats(): stats are not enabled in config.yml')
-        return None
+    sql = "INSERT INTO t_user_totals (username, direction, kind, unit, total, count) VALUES (%s, %s, %s, %s, %s, %s)"
+    sql += " ON DUPLICATE KEY UPDATE total = total + VALUES(total), count = count + VALUES(count)"
+
+    for direction, username in [('tipped', from_user), ('received', to_user)]:
+        for kind, unit, value in [('coin', coin, coin_val), ('fiat', fiat, fiat_val)]:
+            if username and unit and value != None:
+                ctb.db.execute(sql, (username.lower(), direction, kind, unit, sign * float(value), sign))
 
-    users = ctb.db.execute(ctb.conf.db.sql.userstats.users)
-    for u in users:
-        update_user_stats(ctb=ctb, username=u['username'])
+    lg.debug("< update_user_totals() DONE")
+    return True
 
-def update_user_stats(ctb=None, username=None):
+def get_user_totals(ctb=None, username=None):
     """
-    Update individual user stats for given username
+    Return dict of (direction, kind) => [(unit, total), ...] for given username
     """
 
-    if not ctb.conf.reddit.stats.enabled:
-        return None
+    totals = {}
+    for m in ctb.db.execute(ctb.conf.db.sql.userstats.totals, (username)):
+        if m['count'] > 0:
+            totals.setdefault((m['direction'], m['kind']), []).append((m['unit'], m['total']))
+
+    return totals
+
+def get_user_totals_grouped(ctb=None, username=None):
+    """
+    Return dict of (direction, kind) => [(unit, total), ...] for given username,
+    using a single query grouped by coin and fiat (conf.db.sql.userstats.totals_grouped)
+    """
+
+    sql = ctb.conf.db.sql.userstats.totals_grouped
+    sums = {}
+    for m in ctb.db.execute(sql, tuple([username] * sql.count('%s'))):
+        for direction in ['tipped', 'received']:
+            for kind in ['coin', 'fiat']:
+                value = m[direction + '_' + kind]
+                if m[kind] == None or value == None:
+                    continue
+                key = (direction, kind, m[kind])
+                sums[key] = sums.get(key, 0.0) + value
+
+    totals = {}
+    for direction, kind, unit in sorted(sums.keys(), key=lambda k: k[2]):
+        totals.setdefault((direction, kind), []).append((unit, sums[(direction, kind, unit)]))
+
+    return totals
+
+def get_user_totals_legacy(ctb=None, username=None):
+    """
+    Return dict of (direction, kind) => [(unit, total), ...] for given username,
+    using a query per coin/fiat (conf.db.sql.userstats.total_*)
+    """
 
     # List of coins
     coins_q = ctb.db.execute(ctb.conf.db.sql.userstats.coins)
@@ -136,50 +287,261 @@ def update_user_stats(ctb=None, username=None):
     for f in fiat_q:
         fiat.append(f['fiat'])
 
+    totals = {}
+    for direction, kind, units, sql, col in [('tipped', 'fiat', fiat, ctb.conf.db.sql.userstats.total_tipped_fiat, 'total_fiat'),
+                                             ('tipped', 'coin', coins, ctb.conf.db.sql.userstats.total_tipped_coin, 'total_coin'),
+                                             ('received', 'fiat', fiat, ctb.conf.db.sql.userstats.total_received_fiat, 'total_fiat'),
+                                             ('received', 'coin', coins, ctb.conf.db.sql.userstats.total_received_coin, 'total_coin')]:
+        for u in units:
+            mysqlexec = ctb.db.execute(sql, (username, u))
+            total = mysqlexec.fetchone()
+            if total[col] != None:
+                totals.setdefault((direction, kind), []).append((u, total[col]))
+
+    return totals
+
+def check_user_totals(ctb=None, tolerance=0.000001):
+    """
+    Compare t_user_totals with totals computed from t_action,
+    return list of (key, expected (total, count), actual (total, count)) mismatches
+    """
+    lg.debug("> check_user_totals()")
+
+    expected = {}
+    for m in ctb.db.execute(ctb_db.user_totals_select()):
+        expected[(m['username'].lower(), m['direction'], m['kind'], m['unit'])] = (float(m['total']), m['count'])
+
+    actual = {}
+    for m in ctb.db.execute("SELECT username, direction, kind, unit, total, count FROM t_user_totals WHERE count <> 0 OR total <> 0"):
+        actual[(m['username'].lower(), m['direction'], m['kind'], m['unit'])] = (float(m['total']), m['count'])
+
+    result = []
+    for k in sorted(set(expected.keys()) | set(actual.keys())):
+        e = expected.get(k, (0.0, 0))
+        a = actual.get(k, (0.0, 0))
+        if e[1] != a[1] or abs(e[0] - a[0]) > tolerance * max(1.0, abs(e[0])):
+            result.append((k, e, a))
+
+    lg.debug("< check_user_totals() DONE (%s mismatches)", len(result))
+    return result
+
+def update_all_user_stats(ctb=None, workers=None, resume_file=None, limiter=None):
+    """
+    Update individual user stats for all uers, using `workers` threads
+    (default conf.reddit.stats.workers). If resume_file is given, the last username
+    up to which all users are done is saved in it, and users up to it are skipped.
+    resume_file is removed once all users are done.
+    Reddit calls made by this run share limiter, a ctb_misc.TokenBucket
+    (default from conf.reddit.stats.ratelimit, if configured).
+    """
+
+    if not ctb.conf.reddit.stats.enabled:
+        lg.error('update_all_user_stats(): stats are not enabled in config.yml')
+        return None
+
+    if workers == None:
+        workers = ctb.conf.reddit.stats.workers if hasattr(ctb.conf.reddit.stats, 'workers') else 1
+
+    if limiter == None and hasattr(ctb.conf.reddit.stats, 'ratelimit'):
+        limiter = ctb_misc.TokenBucket(rate=ctb.conf.reddit.stats.ratelimit.rate, burst=ctb.conf.reddit.stats.ratelimit.burst)
+
+    # Sorted here rather than relying on SQL ORDER BY, whose collation doesn't order
+    # usernames (such as 'a_b' and 'abc') the way resume comparisons below do
+    users = sorted([u['username'] for u in ctb.db.execute(ctb.conf.db.sql.userstats.users)], key=lambda u: u.lower())
+
+    # Skip users done before interruption
+    if resume_file and os.path.exists(resume_file):
+        last = open(resume_file).read().strip()
+        if last:
+            lg.info("update_all_user_stats(): resuming after '%s'", last)
+            users = [u for u in users if u.lower() > last.lower()]
+
+    progress = {'done': 0, 'failed': 0, 'next': 0, 'started': time.time()}
+    finished = [False] * len(users)
+    lock = threading.Lock()
+    queue = Queue.Queue()
+    for i, u in enumerate(users):
+        queue.put((i, u))
+
+    flair_list = []
+
+    def work(wctb):
+        # Limit applies to this thread only, so that the caller is not limited after this run
+        ctb_misc.reddit_limiter.bucket = limiter
+        try:
+            while True:
+                try:
+                    i, u = queue.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    with wctb.db.unit_of_work():
+                        update_user_stats(ctb=wctb, username=u, flair_list=flair_list)
+                    ok = True
+                except Exception as e:
+                    lg.error("update_all_user_stats(): error updating stats for '%s': %s", u, e)
+                    ok = False
+
+                with lock:
+                    progress['done' if ok else 'failed'] += 1
+                    finished[i] = ok
+
+                    # Save last username before which all users are done
+                    n = progress['next']
+                    while n < len(users) and finished[n]:
+                        n += 1
+                    if resume_file and n > progress['next']:
+                        f = open(resume_file, 'w')
+                        f.write(users[n - 1])
+                        f.close()
+                    progress['next'] = n
+
+                    count = progress['done'] + progress['failed']
+                    if count % 100 == 0 or count == len(users):
+                        elapsed = time.time() - progress['started']
+                        lg.info("update_all_user_stats(): %s/%s users done (%s failed), %.0fs elapsed, ETA %.0fs",
+                                count, len(users), progress['failed'], elapsed, elapsed / count * (len(users) - count))
+        finally:
+            ctb_misc.reddit_limiter.bucket = None
+
+    if workers > 1 and len(users) > 1:
+        # Each worker gets its own Reddit session, PRAW is not thread-safe
+        threads = []
+        for w in range(min(workers, len(users))):
+            wctb = copy.copy(ctb)
+            wctb.reddit = ctb.connect_reddit()
+            t = threading.Thread(target=work, args=(wctb,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            # Join with timeout, so that KeyboardInterrupt gets through
+            while t.is_alive():
+                t.join(1)
+    else:
+        work(ctb)
+
+    ctb_misc.reddit_limiter.bucket = limiter
+    try:
+        submit_flair(ctb=ctb, flair_list=flair_list)
+    finally:
+        ctb_misc.reddit_limiter.bucket = None
+
+    # Run is complete, next run starts from the beginning
+    if resume_file and progress['next'] == len(users) and os.path.exists(resume_file):
+        os.remove(resume_file)
+
+    lg.info("update_all_user_stats(): %s users updated, %s failed", progress['done'], progress['failed'])
+    return progress['failed'] == 0
+
+def mark_user_stats(ctb=None, username=None):
+    """
+    Mark stats of given username as out of date, to be published by flush_user_stats()
+    """
+
+    if not ctb.conf.reddit.stats.enabled or not username:
+        return None
+
+    ctb.runtime['stats']['dirty'][username.lower()] = username
+    return True
+
+def flush_user_stats(ctb=None):
+    """
+    Publish stats of users marked by mark_user_stats(), each user at most
+    once per conf.reddit.stats.publish_interval seconds
+    """
+
+    if not ctb.conf.reddit.stats.enabled:
+        return None
+
+    dirty = ctb.runtime['stats']['dirty']
+    published = ctb.runtime['stats']['published']
+    interval = ctb.conf.reddit.stats.publish_interval if hasattr(ctb.conf.reddit.stats, 'publish_interval') else 0
+    now = time.time()
+
+    counter = 0
+    flair_list = []
+    for k in sorted(dirty.keys()):
+        if published.get(k, 0) + interval > now:
+            continue
+        # A failed user stays marked and is tried again after interval; the rest are still published
+        published[k] = now
+        try:
+            update_user_stats(ctb=ctb, username=dirty[k], flair_list=flair_list)
+        except Exception as e:
+            lg.error("flush_user_stats(): error publishing stats for '%s': %s", dirty[k], e)
+            continue
+        del dirty[k]
+        counter += 1
+
+    try:
+        submit_flair(ctb=ctb, flair_list=flair_list)
+    except Exception as e:
+        lg.error("flush_user_stats(): error submitting flair for %s users: %s", len(flair_list), e)
+        for item in flair_list:
+            dirty[item['user'].lower()] = item['user']
+
+    lg.debug("flush_user_stats(): %s users published, %s deferred", counter, len(dirty))
+    return counter
+
+def update_user_stats(ctb=None, username=None, flair_list=None):
+    """
+    Update individual user stats for given username.
+    If flair_list is given, changed flair is appended to it instead of being submitted.
+    """
+
+    if not ctb.conf.reddit.stats.enabled:
+        return None
+
+    page, user_stats, flair = build_user_stats(ctb=ctb, username=username)
+    return publish_user_stats(ctb=ctb, username=username, page=page, user_stats=user_stats, flair=flair, flair_list=flair_list)
+
+def build_user_stats(ctb=None, username=None):
+    """
+    Return (wiki page name, page contents, flair or None) for given username
+    """
+
     # Start building stats page
     user_stats = "### Tipping Summary for /u/%s\n\n" % username
     page = ctb.conf.reddit.stats.page + '_' + username
 
+    # Totals, from t_user_totals if configured, otherwise computed from t_action
+    if hasattr(ctb.conf.db.sql.userstats, 'totals'):
+        totals = get_user_totals(ctb=ctb, username=username)
+    elif hasattr(ctb.conf.db.sql.userstats, 'totals_grouped'):
+        totals = get_user_totals_grouped(ctb=ctb, username=username)
+    else:
+        totals = get_user_totals_legacy(ctb=ctb, username=username)
+
     # Total Tipped
     user_stats += "#### Total Tipped (Fiat)\n\n"
     user_stats += "fiat|total\n:---|---:\n"
     total_tipped = []
-    for f in fiat:
-        mysqlexec = ctb.db.execute(ctb.conf.db.sql.userstats.total_tipped_fiat, (username, f))
-        total_tipped_fiat = mysqlexec.fetchone()
-        if total_tipped_fiat['total_fiat'] != None:
-            user_stats += "**%s**|%s %.2f\n" % (f, ctb.conf.fiat[f].symbol, total_tipped_fiat['total_fiat'])
-            total_tipped.append("%s%.2f" % (ctb.conf.fiat[f].symbol, total_tipped_fiat['total_fiat']))
+    for f, total in totals.get(('tipped', 'fiat'), []):
+        user_stats += "**%s**|%s %.2f\n" % (f, ctb.conf.fiat[f].symbol, total)
+        total_tipped.append("%s%.2f" % (ctb.conf.fiat[f].symbol, total))
     user_stats += "\n"
 
     user_stats += "#### Total Tipped (Coins)\n\n"
     user_stats += "coin|total\n:---|---:\n"
-    for c in coins:
-        mysqlexec = ctb.db.execute(ctb.conf.db.sql.userstats.total_tipped_coin, (username, c))
-        total_tipped_coin = mysqlexec.fetchone()
-        if total_tipped_coin['total_coin'] != None:
-            user_stats += "**%s**|%s %.6f\n" % (c, ctb.conf.coins[c].symbol, total_tipped_coin['total_coin'])
+    for c, total in totals.get(('tipped', 'coin'), []):
+        user_stats += "**%s**|%s %.6f\n" % (c, ctb.conf.coins[c].symbol, total)
     user_stats += "\n"
 
     # Total received
     user_stats += "#### Total Received (Fiat)\n\n"
     user_stats += "fiat|total\n:---|---:\n"
     total_received = []
-    for f in fiat:
-        mysqlexec = ctb.db.execute(ctb.conf.db.sql.userstats.total_received_fiat, (username, f))
-        total_received_fiat = mysqlexec.fetchone()
-        if total_received_fiat['total_fiat'] != None:
-            user_stats += "**%s**|%s %.2f\n" % (f, ctb.conf.fiat[f].symbol, total_received_fiat['total_fiat'])
-            total_received.append("%s%.2f" % (ctb.conf.fiat[f].symbol, total_received_fiat['total_fiat']))
+    for f, total in totals.get(('received', 'fiat'), []):
+        user_stats += "**%s**|%s %.2f\n" % (f, ctb.conf.fiat[f].symbol, total)
+        total_received.append("%s%.2f" % (ctb.conf.fiat[f].symbol, total))
     user_stats += "\n"
 
     user_stats += "#### Total Received (Coins)\n\n"
     user_stats += "coin|total\n:---|---:\n"
-    for c in coins:
-        mysqlexec = ctb.db.execute(ctb.conf.db.sql.userstats.total_received_coin, (username, c))
-        total_received_coin = mysqlexec.fetchone()
-        if total_received_coin['total_coin'] != None:
-            user_stats += "**%s**|%s %.6f\n" % (c, ctb.conf.coins[c].symbol, total_received_coin['total_coin'])
+    for c, total in totals.get(('received', 'coin'), []):
+        user_stats += "**%s**|%s %.6f\n" % (c, ctb.conf.coins[c].symbol, total)
     user_stats += "\n"
 
     # History
@@ -189,6 +551,8 @@ def update_user_stats(ctb=None, username=None):
     user_stats += ("|".join([":---"] * len(history.keys()))) + "\n"
 
     # Build history table
+    plan = format_plan(history.keys(), username, ctb)
+    rows = []
     num_tipped = 0
     num_received = 0
     for m in history:
@@ -197,20 +561,11 @@ def update_user_stats(ctb=None, username=None):
                 num_tipped += 1
             elif m['to_user'].lower() == username.lower():
                 num_received += 1
-        values = []
-        for k in history.keys():
-            values.append(format_value(m, k, username, ctb))
-        user_stats += ("|".join(values)) + "\n"
+        rows.append(("|".join([f(m) for f in plan])) + "\n")
+    user_stats += "".join(rows)
 
-    # Submit changes
-    lg.debug("update_user_stats(): updating subreddit '%s', page '%s'" % (ctb.conf.reddit.stats.subreddit, page))
-    
-    w = ctb_misc.praw_call(ctb.reddit.subreddit, ctb.conf.reddit.stats.subreddit).wiki
-    wp = ctb_misc.praw_call(w.__getitem__, page)
-
-    ctb_misc.praw_call(wp.edit, user_stats, "Update by ALTcointip bot")
-
-    # Update user flair on subreddit
+    # Build user flair
+    flair = None
     if ctb.conf.reddit.stats.userflair and ( len(total_tipped) > 0 or len(total_received) > 0 ):
         flair = ""
         if len(total_tipped) > 0:
@@ -221,77 +576,195 @@ def update_user_stats(ctb=None, username=None):
                 flair += " / "
             flair += "received[" + '|'.join(total_received) + "]"
             flair += " (%d)" % num_received
+
+    return (page, user_stats, flair)
+
+def publish_user_stats(ctb=None, username=None, page=None, user_stats=None, flair=None, flair_list=None):
+    """
+    Submit user stats page and flair to Reddit, unless they are unchanged since last published.
+    If flair_list is given, changed flair is appended to it instead of being submitted.
+    """
+
+    hashes = ctb.runtime['stats']['hashes']
+
+    # Submit changes
+    digest = hashlib.md5(user_stats.encode('utf-8') if isinstance(user_stats, unicode) else user_stats).hexdigest()
+    if hashes.get(('page', page)) == digest:
+        lg.debug("update_user_stats(): page '%s' unchanged, skipping" % page)
+    else:
+        lg.debug("update_user_stats(): updating subreddit '%s', page '%s'" % (ctb.conf.reddit.stats.subreddit, page))
+
+        w = ctb_misc.praw_call(ctb.reddit.subreddit, ctb.conf.reddit.stats.subreddit).wiki
+        wp = ctb_misc.praw_call(w.__getitem__, page)
+
+        ctb_misc.praw_call(wp.edit, user_stats, "Update by ALTcointip bot")
+        hashes[('page', page)] = digest
+
+    # Update user flair on subreddit
+    if flair != None and hashes.get(('flair', username.lower())) != flair:
         lg.debug("update_user_stats(): updating flair for %s (%s)", username, flair)
-        r = ctb_misc.praw_call(ctb.reddit.subreddit, ctb.conf.reddit.stats.subreddit)
-        res = ctb_misc.praw_call(r.flair.set, username, flair, '')
-        lg.debug(res)
+        item = {'user': username, 'flair_text': flair, 'flair_css_class': ''}
+        if flair_list != None:
+            flair_list.append(item)
+        else:
+            submit_flair(ctb=ctb, flair_list=[item])
 
     return True
 
-def format_value(m, k, username, ctb, compact=False):
+def get_flair(ctb=None):
     """
-    Format value for display based on its type
-    m[k] is the value, k is the database row name
+    Return flair object of stats subreddit (or a CtbFakeFlair if conf.reddit.stats.fake_flair is set)
     """
 
-    if not m[k]:
-        return '-'
+    if hasattr(ctb.conf.reddit.stats, 'fake_flair') and ctb.conf.reddit.stats.fake_flair:
+        if not ctb.runtime['stats'].has_key('fake_flair'):
+            ctb.runtime['stats']['fake_flair'] = CtbFakeFlair()
+        return ctb.runtime['stats']['fake_flair']
 
-    # Format cryptocoin
-    if type(m[k]) == float and k.find("coin") > -1:
-        coin_symbol = ctb.conf.coins[m['coin']].symbol
-        return "%s&nbsp;%.5g" % (coin_symbol, m[k])
+    r = ctb_misc.praw_call(ctb.reddit.subreddit, ctb.conf.reddit.stats.subreddit)
+    return r.flair
 
-    # Format fiat
-    elif type(m[k]) == float and ( k.find("fiat") > -1 or k.find("usd") > -1 ):
-        fiat_symbol = ctb.conf.fiat[m['fiat']].symbol
-        return "%s&nbsp;%.2f" % (fiat_symbol, m[k])
+def submit_flair(ctb=None, flair_list=None):
+    """
+    Submit flair_list (list of {'user', 'flair_text', 'flair_css_class'} dicts) in batches of FLAIR_BATCH_SIZE
+    """
 
-    # Format username
-    elif k.find("user") > -1 and type( m[k] ) in [str, unicode]:
-        if compact:
-            return ("**/u/%s**" % m[k]) if m[k].lower() == username.lower() else ("/u/%s" % m[k])
-        else:
-            un = ("**%s**" % m[k]) if m[k].lower() == username.lower() else m[k]
-            toreturn = "[%s](/u/%s)" % (un, re.escape(m[k]))
-            if m[k].lower() != username.lower():
-                toreturn += "^[[stats]](/r/%s/wiki/%s_%s)" % (ctb.conf.reddit.stats.subreddit, ctb.conf.reddit.stats.page, m[k])
-            return toreturn
-
-    # Format address
-    elif k.find("addr") > -1:
-        displayaddr = m[k][:6] + "..." + m[k][-5:]
-        return "[%s](%s%s)" % (displayaddr, ctb.conf.coins[m['coin']].explorer.address, m[k])
-
-    # Format state
-    elif k.find("state") > -1:
-        if m[k] == 'completed':
-            return unicode('✓', 'utf8')
-        else:
-            return m[k]
+    if not flair_list:
+        return 0
+
+    flair = get_flair(ctb=ctb)
+    for i in range(0, len(flair_list), FLAIR_BATCH_SIZE):
+        batch = flair_list[i:i + FLAIR_BATCH_SIZE]
+        lg.debug("submit_flair(): updating flair for %s users", len(batch))
+        res = ctb_misc.praw_call(flair.update, batch)
+        lg.debug(res)
+        for item in batch:
+            ctb.runtime['stats']['hashes'][('flair', item['user'].lower())] = item['flair_text']
+
+    return len(flair_list)
+
+# Maximum number of formatter plans kept in ctb.runtime['formatters'],
+# and of formatted values (usernames, dates) remembered by each column formatter
+FORMAT_PLANS_MAX = 1000
+FORMAT_VALUES_MAX = 10000
+
+def format_plan(keys, username, ctb, compact=False):
+    """
+    Return a list of formatters, one per column in keys, such that
+    plan[i](m) == format_value(m, keys[i], username, ctb, compact)
+    Plans are cached in ctb.runtime['formatters'].
+    """
+
+    # Cache is shared by worker threads: look up once and keep a local reference,
+    # so that another thread clearing the cache can't make the lookup fail
+    plans = ctb.runtime['formatters']
+    key = (tuple(keys), username.lower(), compact)
+    plan = plans.get(key)
+    if plan is None:
+        plan = [format_column(k, username, ctb, compact) for k in keys]
+        if len(plans) >= FORMAT_PLANS_MAX:
+            plans.clear()
+        plans[key] = plan
 
-    # Format type
+    return plan
+
+def format_column(k, username, ctb, compact=False):
+    """
+    Return a function formatting value m[k] of row m, deciding once (by
+    column name) which of the format_value() rules can apply
+    """
+
+    is_coin = k.find("coin") > -1
+    is_fiat = k.find("fiat") > -1 or k.find("usd") > -1
+    is_user = k.find("user") > -1
+    username = username.lower()
+    coin_symbols = {}
+    fiat_symbols = {}
+
+    # Format username (same names repeat a lot, so results are remembered)
+    users = {}
+    if compact:
+        def user_link(v):
+            return ("**/u/%s**" % v) if v.lower() == username else ("/u/%s" % v)
+    else:
+        stats_link = "^[[stats]](/r/%s/wiki/%s_" % (ctb.conf.reddit.stats.subreddit, ctb.conf.reddit.stats.page)
+        def user_link(v):
+            if v.lower() == username:
+                return "[**%s**](/u/%s)" % (v, re.escape(v))
+            return "[%s](/u/%s)" % (v, re.escape(v)) + stats_link + v + ")"
+    def format_user(v):
+        s = users.get(v)
+        if s is None:
+            s = user_link(v)
+            if len(users) >= FORMAT_VALUES_MAX:
+                users.clear()
+            users[v] = s
+        return s
+
+    # Rules that only depend on column name
+    if k.find("addr") > -1:
+        def format_rest(m, v):
+            return "[%s](%s%s)" % (v[:6] + "..." + v[-5:], ctb.conf.coins[m['coin']].explorer.address, v)
+    elif k.find("state") > -1:
+        check = unicode('✓', 'utf8')
+        def format_rest(m, v):
+            return check if v == 'completed' else v
     elif k.find("type") > -1:
-        if m[k] == 'givetip':
-            return 'tip'
+        types = {'givetip': 'tip'}
         if compact:
-            if m[k] == 'withdraw':
-                return 'w'
-            if m[k] == 'redeem':
-                return 'r'
-
-    # Format subreddit
+            types.update({'withdraw': 'w', 'redeem': 'r'})
+        def format_rest(m, v):
+            return types.get(v)
     elif k.find("subreddit") > -1:
-        return "/r/%s" % m[k]
-
-    # Format link
+        def format_rest(m, v):
+            return "/r/%s" % v
     elif k.find("link") > -1:
-        return "[link](%s)" % m[k]
-
-    # Format time
+        def format_rest(m, v):
+            return "[link](%s)" % v
     elif k.find("utc") > -1:
-        return "%s" % time.strftime('%Y-%m-%d', time.localtime(m[k]))
-
-    # It's something else
+        # Local dates change on quarter-hour boundaries (time zone offsets and
+        # DST transitions are multiples of 15 minutes), so cache by quarter-hour
+        days = {}
+        def format_rest(m, v):
+            q = v - v % 900
+            s = days.get(q)
+            if s is None:
+                s = "%s" % time.strftime('%Y-%m-%d', time.localtime(v))
+                if len(days) >= FORMAT_VALUES_MAX:
+                    days.clear()
+                days[q] = s
+            return s
     else:
-        return str(m[k])
+        def format_rest(m, v):
+            return str(v)
+
+    def format_cell(m):
+        v = m[k]
+        if not v:
+            return '-'
+        if type(v) == float:
+            # Format cryptocoin
+            if is_coin:
+                symbol = coin_symbols.get(m['coin'])
+                if symbol is None:
+                    symbol = coin_symbols[m['coin']] = ctb.conf.coins[m['coin']].symbol
+                return "%s&nbsp;%.5g" % (symbol, v)
+            # Format fiat
+            if is_fiat:
+                symbol = fiat_symbols.get(m['fiat'])
+                if symbol is None:
+                    symbol = fiat_symbols[m['fiat']] = ctb.conf.fiat[m['fiat']].symbol
+                return "%s&nbsp;%.2f" % (symbol, v)
+        if is_user and type(v) in [str, unicode]:
+            return format_user(v)
+        return format_rest(m, v)
+
+    return format_cell
+
+def format_value(m, k, username, ctb, compact=False):
+    """
+    Format value for display based on its type
+    m[k] is the value, k is the database row name
+    """
+
+    return format_plan([k], username, ctb, compact)[0](m)
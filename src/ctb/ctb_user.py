@@ -77,9 +77,10 @@ class CtbUser(object):
         me = me % (self.name, self.giftamount, self.joindate, self.addr, self.prawobj, self.banned)
         return me
 
-    def get_balance(self, coin=None, kind=None):
+    def get_balance(self, coin=None, kind=None, strict=False):
         """
         If coin is specified, return float with coin balance for user. Else, return a dict with balance of each coin for user.
+        If strict is True, ask coin daemon even if balance is cached.
         """
         lg.debug("> CtbUser::balance(%s)", self.name)
 
@@ -88,7 +89,7 @@ class CtbUser(object):
 
         # Ask coin daemon for account balance
         lg.info("CtbUser::balance(%s): getting %s %s balance", self.name, coin, kind)
-        balance = self.ctb.coins[coin].getbalance(_user=self.name, _minconf=self.ctb.conf.coins[coin].minconf[kind])
+        balance = self.ctb.coins[coin].getbalance(_user=self.name, _minconf=self.ctb.conf.coins[coin].minconf[kind], _strict=strict)
 
         lg.debug("< CtbUser::balance(%s) DONE", self.name)
         return float(balance)
@@ -224,10 +225,11 @@ class CtbUser(object):
             lg.error("CtbUser::register(%s): exception while executing <%s>: %s", self.name, sql_adduser % (self.name.lower()), e)
             raise
 
-        # Get new coin addresses
-        new_addrs = {}
-        for c in self.ctb.coins:
-            new_addrs[c] = self.ctb.coins[c].getnewaddr(_user=self.name.lower())
+        # Get coin addresses (from address pool, if it's filled) from all coin daemons at once
+        new_addrs, errors = self.ctb.each_coin(lambda c: ctb_misc.claim_addr(c, self.name, self.ctb.db, self.ctb.coins))
+        if errors:
+            raise errors[sorted(errors)[0]]
+        for c in sorted(new_addrs):
             lg.info("CtbUser::register(%s): got %s address %s", self.name, c, new_addrs[c])
 
         # Add coin addresses to database
@@ -3,21 +3,16 @@ import cointipbot, traceback, time
 class Main():
     cb = None
 
-    def __init__(self):
+    def main(self):
         '''
-        Unfortunately, we cannot instantiate CointipBot only once due to the way pifkoin works. 
-
-        Pifkoin will open an HTTP connection to the RPC client which will eventually close when the bot completes its checks. Therefore, if we try to loop
-        CointipBot.main() without reinstanting the object, httplib will throw BadStatusLine because the connection is no longer valid and cannot be used.
-
-        May make a pull request to pifkoin to resolve this. If this does get resolved in pifkoin or you locally modify your pifkoin copy to resolve this, you can
-        uncomment the following line and comment the self.cb assignment in main(). This will ensure we do not need to reinstantiate CoinbotTip in every iteration.
+        CointipBot is instantiated once and reused for every iteration. Coin daemon connections
+        (ctb_rpc) reconnect on their own when the daemon closes them, so a new instance is only
+        created after an error. Self-checks still run before every iteration, as they did when
+        CointipBot was instantiated for each one.
         '''
-        # self.cb = cointipbot.CointipBot()
-
-    def main(self):
-        self.cb = cointipbot.CointipBot()
-
+        if self.cb is None:
+            self.cb = cointipbot.CointipBot(self_checks=False)
+        self.cb.self_checks()
         self.cb.main()
 
 def secondary(main):
@@ -25,6 +20,7 @@ def secondary(main):
         while True:
             main.main();
     except:
+        main.cb = None
         traceback.print_exc()
         print('Resuming in 7 seconds')
         time.sleep(7)
@@ -33,4 +29,4 @@ def secondary(main):
 while True:
     main = Main()
 
-    secondary(main)
\ No newline at end of file
+    secondary(main)